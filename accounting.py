@@ -0,0 +1,122 @@
+from __future__ import print_function
+import threading
+import database
+import atexit
+import time
+
+
+class AccessAccounting(object):
+    """
+    Counts downloads, bytes served and the last access time of each link in
+    memory, and writes them to the database in one transaction every
+    `interval` seconds, or sooner once `max_pending` links have counts
+    waiting. Recording a download never touches the database, so serving a
+    link costs no write.
+
+    Counts still waiting when the process exits are written on the way out;
+    those of a process that's killed are lost.
+    """
+    def __init__(self, interval=10, max_pending=1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.recorded = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._due = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def record(self, file_id, served=0, when=None):
+        """Counts a download of `file_id` that served `served` bytes."""
+        if when is None:
+            when = time.time()
+        with self._lock:
+            counts = self.pending.get(file_id)
+            if counts is None:
+                counts = self.pending[file_id] = [0, 0, when]
+            counts[0] += 1
+            counts[1] += served
+            counts[2] = max(counts[2], when)
+            self.recorded += 1
+            if len(self.pending) >= self.max_pending:
+                self._due.set()
+
+    def flush(self):
+        """
+        Writes every pending count to the database. Returns the number of
+        links written. If the write fails, the counts are kept for next time.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        try:
+            database.AlchemyDatabase().record_access(pending)
+        except Exception:
+            self.failures += 1
+            with self._lock:
+                for file_id, (downloads, served, when) in pending.items():
+                    counts = self.pending.setdefault(file_id, [0, 0, when])
+                    counts[0] += downloads
+                    counts[1] += served
+                    counts[2] = max(counts[2], when)
+            raise
+        finally:
+            database.remove_session()
+        with self._lock:
+            self.flushes += 1
+            self.flushed_rows += len(pending)
+        return len(pending)
+
+    def run(self):
+        """Flushes every `interval` seconds, or when told to, until stopped."""
+        while not self._stopped:
+            self._due.wait(self.interval)
+            self._due.clear()
+            try:
+                self.flush()
+            except Exception as err:
+                print("Writing download counts failed:", err)
+
+    def start(self):
+        """Starts flushing in the background, and once more at exit."""
+        if self._thread is not None:
+            return
+        self._stopped = False
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops the background flushes, and writes whatever's left."""
+        self._stopped = True
+        self._due.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Returns the number of downloads recorded, and how they're written."""
+        with self._lock:
+            return {
+                'recorded': self.recorded,
+                'pending': len(self.pending),
+                'flushes': self.flushes,
+                'flushed_rows': self.flushed_rows,
+                'failures': self.failures
+            }
+
+# The process-wide accounting buffer, set up by `configure`.
+ACCOUNTING = AccessAccounting()
+
+
+def configure(config):
+    """Sets up the process-wide accounting buffer and starts flushing it."""
+    ACCOUNTING.interval = config.accounting_interval
+    ACCOUNTING.max_pending = config.accounting_max_pending
+    ACCOUNTING.start()
@@ -3,10 +3,16 @@ from __future__ import print_function
 from werkzeug.wsgi import DispatcherMiddleware
 from frontend import app as frontend
 import proxy_response
+import buffer_pool
+import cache_manager
+import expiry_reaper
+import accounting
 import database as appdb
 import httplib
 import urllib
-import gc
+
+
+CONFIG = appdb.ConfigReader()
 
 
 # This is a weird way to create a sort of 'enum'
@@ -24,28 +30,6 @@ class RequestType:
 
 
 
-def extract_request_headers(environ):
-    """Extracts the request headers sent by the client from the environment variables."""
-    to_return = {}
-    for key in environ.keys():
-        if key.startswith("HTTP_"):
-            to_return[key[5:]] = environ[key]
-    return to_return
-
-def format_response_headers(response):
-    """Formats a dictionary of response headers into a list of tuples."""
-    raw_headers = response.response_headers
-    try:
-        if not proxy_response.get_nocase(raw_headers, 'Content-Disposition'):
-            raw_headers['Content-Disposition'] =\
-            'inline; filename="{}"'.format(response.filename)
-    except Exception:
-        pass
-    raw_headers = [(x, raw_headers[x]) for x in raw_headers]
-    return raw_headers
-
-
-
 def get_url(environ):
     """Get's the URL to be fetched."""
     should_cache = remote = file_id = None
@@ -72,15 +56,29 @@ def get_url(environ):
 
 
 
-def get_request_type(request_value):
-    """Returns the type of the request, as well as the remote path to the file."""
-    request_type = None
-    sql_db = appdb.AlchemyDatabase()
-    # path_info = environ['PATH_INFO'][1:]
+def build_request_context(environ, sql_db):
+    """
+    Resolves a request exactly once, looking up its entry if it names a
+    file_id, and returns the RequestContext that every response type uses.
+    """
+    request_value = environ['PATH_INFO'][1:]
+    request_headers = proxy_response.extract_request_headers(environ)
+    entry = remote_url = None
 
     if "://" not in request_value:
         entry = sql_db.get_entry(request_value)
-        if entry:
+    else:
+        remote_url = encode_url(request_value)
+    return proxy_response.RequestContext(
+        request_value, request_headers, entry, remote_url)
+
+
+def get_request_type(context):
+    """Returns the type of the request described by `context`."""
+    request_type = None
+
+    if "://" not in context.request_value:
+        if context.entry:
             request_type = RequestType.file_id
     else:
         request_type = RequestType.direct
@@ -128,52 +126,160 @@ def caching_proxy(environ, start_response):
     3. A non-valid string
         - Respond with error
     """
-    gc.collect()
-
     response = status = None
 
-    request_value = environ['PATH_INFO'][1:]
-    request_headers = extract_request_headers(environ)
-    request_type = get_request_type(request_value)
+    sql_db = appdb.AlchemyDatabase()
+    context = build_request_context(environ, sql_db)
+    request_type = get_request_type(context)
 
     if request_type == RequestType.direct:
-        url = encode_url(request_value)
-        response = proxy_response.ProxyResponse(url, request_headers)
+        response = proxy_response.ProxyResponse(context)
     elif request_type == RequestType.file_id:
-        sql_db = appdb.AlchemyDatabase()
-        file_id = request_value
-        config = appdb.ConfigReader()
         response = proxy_response.CacheResponse(
-            file_id,
-            request_headers,
+            context,
             sql_db,
-            config
+            CONFIG
         )
     elif request_type == RequestType.other:
-        response = proxy_response.OtherResponse()
+        response = proxy_response.OtherResponse(context)
 
-    response_headers = format_response_headers(response)
+    response_headers = proxy_response.format_response_headers(response)
     status = response.response_status
+    if request_type == RequestType.file_id and \
+            status.startswith(("200", "206")):
+        accounting.ACCOUNTING.record(context.file_id,
+                                     proxy_response.served_bytes(response))
+    # Everything needed to serve the body is in the context by now, so this
+    # thread is done with the database.
+    appdb.remove_session()
     # print(status, response_headers)
     # print(response)
     start_response(status, response_headers)
+    if request_type == RequestType.file_id:
+        return response.wsgi_body(environ)
     return response
 
 
+appdb.init_database(
+    entry_cache_size=CONFIG.entry_cache_size,
+    entry_cache_max_age=CONFIG.entry_cache_max_age,
+    file_id_length=CONFIG.file_id_length,
+    file_id_alphabet=CONFIG.file_id_alphabet
+)
+buffer_pool.configure(CONFIG.chunk_pool_buffers)
+proxy_response.configure(CONFIG)
+cache_manager.configure(CONFIG)
+expiry_reaper.configure(CONFIG)
+accounting.configure(CONFIG)
+
 APPLICATION = DispatcherMiddleware(frontend, {
     '/get': caching_proxy
 })
 
 def test_enum():
     vals = ['blag', '://', 'x78x5w653x']
+    sql_db = appdb.AlchemyDatabase()
     for v in vals:
-        request_type = get_request_type(v)
+        context = build_request_context({'PATH_INFO': '/'+v}, sql_db)
+        request_type = get_request_type(context)
         print(v)
         if request_type == RequestType.direct: print('direct')
         elif request_type == RequestType.file_id: print('file_id')
         elif request_type == RequestType.other: print('other')
         else: print("Not any type of request (this is bad)")
 
+def test_query_count(local_file=__file__):
+    """
+    Checks that serving a cached file_id hits the `files` table at most once
+    per request, and not at all once the entry cache is warm.
+    """
+    from sqlalchemy import event
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    queries = []
+    def count_query(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            queries.append(statement)
+    engine = appdb.get_session_registry().get_bind()
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    sql_db = appdb.AlchemyDatabase()
+    file_id = sql_db.new_entry(local_file)
+    sql_db.entry_cache.clear()
+    client = Client(APPLICATION, BaseResponse)
+    try:
+        for headers, expected in [({}, 1), ({}, 0), ({'Range': 'bytes=0-9'}, 0)]:
+            del queries[:]
+            resp = client.get('/get/'+file_id, headers=headers)
+            resp.close()
+            print(resp.status, "queries:", len(queries))
+            assert len(queries) <= expected
+    finally:
+        event.remove(engine, 'before_cursor_execute', count_query)
+        sql_db.remove_entry(file_id)
+
+def test_local_files_kept():
+    """
+    Checks that serving a file from a bucket, with the cache over its limit,
+    doesn't make it a candidate for eviction.
+    """
+    import tempfile
+    import shutil
+    import os
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    bucket = tempfile.mkdtemp()
+    local_file = os.path.join(bucket, 'precious.bin')
+    with open(local_file, 'wb') as t_file:
+        t_file.write(b'x' * 1000)
+    cache = cache_manager.CACHE
+    saved = cache.directory, cache.max_bytes, cache.min_free_bytes
+    # An empty cache, so a tight limit doesn't evict anything real.
+    cache.directory, cache.max_bytes, cache.min_free_bytes = \
+        tempfile.mkdtemp(), 1, 0
+    cache.scan()
+    sql_db = appdb.AlchemyDatabase()
+    file_id = sql_db.new_entry(local_file)
+    try:
+        resp = Client(APPLICATION, BaseResponse).get('/get/'+file_id)
+        resp.close()
+        cache.make_room(10)
+        print(resp.status, "still there:", os.path.exists(local_file))
+        assert os.path.exists(local_file)
+    finally:
+        sql_db.remove_entry(file_id)
+        shutil.rmtree(cache.directory)
+        cache.directory, cache.max_bytes, cache.min_free_bytes = saved
+        cache.scanned = None
+        shutil.rmtree(bucket)
+
+def test_multi_extent_resume(url):
+    """
+    Checks that a full download of `url`, which must be uncached and from an
+    origin that serves ranges, matches the origin byte for byte when it picks
+    up a partial file that two range requests have left in separate pieces.
+    """
+    import urllib2
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    expected = urllib2.urlopen(url).read()
+    sql_db = appdb.AlchemyDatabase()
+    file_id = sql_db.new_entry(url)
+    client = Client(APPLICATION, BaseResponse)
+    try:
+        for range_header in ['bytes=100-199', 'bytes=-100']:
+            # Read, so the ranges are fetched into the partial file.
+            client.get('/get/'+file_id, headers={'Range': range_header}).data
+        resp = client.get('/get/'+file_id)
+        body = resp.data
+        print(resp.status, len(body), "matches:", body == expected)
+        assert body == expected
+    finally:
+        sql_db.remove_entry(file_id)
+
 
 if __name__ == '__main__':
     # test_enum()
@@ -0,0 +1,772 @@
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin, quote, unquote
+from byte_ranges import MultipartByteranges, RangeNotSatisfiable,\
+    parse_range_header, content_range, unsatisfiable_range
+from cache_fill import CacheFill, MAX_RESUMES, PENDING, STREAMING, DONE,\
+    FAILED, content_length, validator, get_header
+from cache_manager import CACHE
+from cache_store import object_key
+import cache_manager
+import accounting
+import database
+import offload
+import mimetypes
+import asyncio
+import os.path
+import time
+import ssl
+import os
+
+# An engine for /get that serves the same requests as app.py's, in the same
+# way, from one event loop instead of a thread or two per download. Origins
+# are read without blocking; what can't be done without blocking (reading
+# and writing files, the database) is handed to a small pool of threads, so
+# one process can keep thousands of downloads going. It's an ASGI
+# application, for Python 3.6 or later:
+#
+#     uvicorn async_proxy:APPLICATION
+#
+# with the front end, and /get too if wanted, still served by app.py. Two
+# things are left to the threaded engine: range requests for files that
+# aren't cached yet are passed through to the origin rather than cached
+# segment by segment, and every fill is made over one connection, whatever
+# `parallel_fill` says.
+
+# How many bytes a download reads at a time. Smaller than the threaded
+# engine's chunks, since every open download holds one.
+CHUNK_SIZE = 65536
+
+# How long, in seconds, to wait on an origin to connect or send something, as
+# the threaded engine does.
+ORIGIN_TIMEOUT = 3
+
+# How many redirects from an origin are followed, as urllib2 does.
+MAX_REDIRECTS = 10
+
+# Headers that are about one connection rather than the file, and are never
+# passed on in either direction.
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailer',
+                        'transfer-encoding', 'upgrade'])
+
+SSL_CONTEXT = ssl.create_default_context()
+
+# Where app.py mounts the proxy; request paths are taken with or without it.
+MOUNT = '/get'
+
+# Runs whatever would block the event loop; set up by `configure`.
+IO_POOL = None
+
+# Fills running in this process, by cached object key.
+_FILLS = {}
+
+
+def call_and_close(func, args):
+    """Calls `func(*args)`, then lets go of this thread's database session."""
+    try:
+        return func(*args)
+    finally:
+        database.remove_session()
+
+
+async def blocking(func, *args):
+    """Runs `func(*args)` on the I/O pool, and returns what it returns."""
+    return await asyncio.get_event_loop().run_in_executor(
+        IO_POOL, call_and_close, func, args)
+
+
+async def read_at(fd, size, offset):
+    """Reads at most `size` bytes at `offset` of the open file `fd`."""
+    return await asyncio.get_event_loop().run_in_executor(
+        IO_POOL, os.pread, fd, size, offset)
+
+
+def encode_url(request_value):
+    """Re-escapes a URL from the request path, as app.encode_url does."""
+    return "".join([request_value[:8], quote(request_value[8:])])
+
+
+def url_filename(url):
+    """The name of the file at `url`."""
+    return os.path.basename(urlsplit(url or "").path)
+
+
+def passed_headers(headers):
+    """An origin's response headers, minus those about the connection."""
+    return {key: headers[key] for key in headers
+            if key.lower() not in HOP_BY_HOP}
+
+
+class OriginResponse(object):
+    """
+    A response from an origin, its body read as it's asked for. Chunked
+    bodies are decoded.
+    """
+    def __init__(self, reader, writer, code, headers, method="GET",
+                 timeout=ORIGIN_TIMEOUT):
+        self.reader = reader
+        self.writer = writer
+        self.code = code
+        self.headers = headers
+        self.timeout = timeout
+        self.remaining = content_length(headers)
+        self.chunked = 'chunked' in \
+            (get_header(headers, 'transfer-encoding') or '').lower()
+        self.chunk_left = 0
+        self.done = method == "HEAD" or code in (204, 304) or \
+            code < 200 or (self.remaining == 0 and not self.chunked)
+
+    async def readline(self):
+        """Reads a line, giving up if the origin goes quiet."""
+        return await asyncio.wait_for(self.reader.readline(), self.timeout)
+
+    async def read_some(self, size):
+        """Reads at most `size` bytes, giving up if the origin goes quiet."""
+        return await asyncio.wait_for(self.reader.read(size), self.timeout)
+
+    async def read(self, size=CHUNK_SIZE):
+        """
+        Returns at most `size` bytes of the body, or b"" at its end. Raises
+        IOError if the origin hangs up before the end.
+        """
+        if self.done:
+            return b""
+        if self.chunked:
+            if not self.chunk_left:
+                line = await self.readline()
+                try:
+                    self.chunk_left = int(line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise IOError("Origin sent a bad chunk.")
+                if not self.chunk_left:
+                    # Whatever trailers there are aren't passed on.
+                    while (await self.readline()).strip():
+                        pass
+                    self.done = True
+                    return b""
+            data = await self.read_some(min(size, self.chunk_left))
+            if not data:
+                raise IOError("Origin closed the connection early.")
+            self.chunk_left -= len(data)
+            if not self.chunk_left:
+                await self.readline()
+            return data
+
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        data = await self.read_some(size)
+        if not data:
+            if self.remaining:
+                raise IOError("Origin closed the connection early.")
+            self.done = True
+            return b""
+        if self.remaining is not None:
+            self.remaining -= len(data)
+            self.done = not self.remaining
+        return data
+
+    async def body(self):
+        """Yields the body as it arrives."""
+        while True:
+            data = await self.read()
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        """Hangs up on the origin."""
+        self.writer.close()
+
+
+async def open_origin(url, headers, method="GET", timeout=ORIGIN_TIMEOUT):
+    """
+    Requests `url` from its origin with the request headers `headers` (a
+    dict), following redirects, and returns the OriginResponse once its
+    headers are in. Raises IOError or asyncio.TimeoutError if the origin
+    can't be reached, or goes `timeout` seconds without answering.
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        # Like urllib2, takes the host as it would be unescaped, since
+        # encode_url escapes the port's colon along with the path.
+        netloc = unquote(parts.netloc).rpartition('@')[2]
+        address = urlsplit('//' + netloc)
+        if parts.scheme not in ('http', 'https') or not address.hostname:
+            raise IOError("Can't fetch {0}".format(url))
+        secure = parts.scheme == 'https'
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            address.hostname, address.port or (443 if secure else 80),
+            ssl=SSL_CONTEXT if secure else None), timeout)
+        try:
+            target = (parts.path or '/') + \
+                ('?' + parts.query if parts.query else '')
+            lines = ["{0} {1} HTTP/1.1".format(method, target),
+                     "Host: " + netloc,
+                     "Connection: close"]
+            lines += ["{0}: {1}".format(key, value)
+                      for key, value in headers.items()
+                      if key.lower() not in HOP_BY_HOP and
+                      key.lower() != 'host']
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+            status = await asyncio.wait_for(reader.readline(), timeout)
+            try:
+                code = int(status.split(None, 2)[1])
+            except (IndexError, ValueError):
+                raise IOError("Origin sent a bad response.")
+            response_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                line = line.decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                key, value = key.strip().lower(), value.strip()
+                if key in response_headers:
+                    value = response_headers[key] + ", " + value
+                response_headers[key] = value
+        except BaseException:
+            writer.close()
+            raise
+
+        location = response_headers.get('location')
+        if code in (301, 302, 303, 307, 308) and location:
+            writer.close()
+            url = urljoin(url, location)
+            continue
+        return OriginResponse(reader, writer, code, response_headers, method,
+                              timeout)
+    raise IOError("Too many redirects from the origin.")
+
+
+class AsyncFill(object):
+    """
+    A cache fill driven by the event loop. The download is read from the
+    origin as it arrives and handed to a CacheFill, which writes it to the
+    cache on the I/O pool and takes care of the lease and of storing the
+    finished object. Every request for the file, the one that started the
+    fill included, follows along on disk, so the fill carries on to the end
+    even if they all go away.
+    """
+    def __init__(self, url, config, headers=None):
+        self.url = url
+        self.fill = CacheFill(url, config)
+        # For asking for the rest of a download that's cut off.
+        self.headers = {key: value for key, value in (headers or {}).items()
+                        if key.lower() not in ('range', 'if-range')}
+        self.state = PENDING
+        self.response_code = None
+        self.response_headers = None
+        self.accepts_ranges = False
+        self.resumes = 0
+        self.cond = asyncio.Condition()
+
+    @classmethod
+    def join_or_create(cls, url, config, headers=None):
+        """
+        Returns `(fill, created)`: the fill already running in this process
+        for `url`, or a new, registered one that the caller must start.
+        """
+        key = object_key(url)
+        fill = _FILLS.get(key)
+        if fill is not None:
+            return fill, False
+        fill = _FILLS[key] = cls(url, config, headers)
+        return fill, True
+
+    async def start(self, origin):
+        """
+        Starts filling from `origin`, the response to the request that made
+        the fill. Returns False, and fails the fill, if the response can't be
+        cached or another fill already holds the lease.
+        """
+        headers = origin.headers
+        started = False
+        try:
+            # Only a complete, unencoded body is any use to the cache.
+            if origin.code == 200 and \
+                    not get_header(headers, 'content-encoding'):
+                started = await blocking(self.fill.start, 200, headers)
+            else:
+                await blocking(self.fill.abort)
+        except Exception as err:
+            print("Couldn't start filling the cache:", err)
+        if not started:
+            await self.end(FAILED)
+            return False
+        self.response_code = 200
+        self.response_headers = passed_headers(headers)
+        self.accepts_ranges = \
+            (get_header(headers, 'accept-ranges') or '') == 'bytes'
+        async with self.cond:
+            self.state = STREAMING
+            self.cond.notify_all()
+        asyncio.ensure_future(self.run(origin))
+        return True
+
+    async def run(self, origin):
+        """Writes the download to the cache, then stores it."""
+        fill = self.fill
+        written = False
+        try:
+            while True:
+                try:
+                    data = await origin.read(CHUNK_SIZE)
+                    if not data and fill.size is not None and \
+                            fill.written < fill.size:
+                        raise IOError("Origin closed the connection early.")
+                except (IOError, asyncio.TimeoutError):
+                    resumed = await self.resume()
+                    if resumed is None:
+                        raise
+                    origin.close()
+                    origin = resumed
+                    continue
+                if not data:
+                    break
+                await blocking(fill.write, data)
+                async with self.cond:
+                    self.cond.notify_all()
+            written = True
+            await blocking(fill.finish)
+            await self.end(DONE)
+        except Exception as err:
+            print("Filling the cache from", self.url, "failed:", err)
+            if not written:
+                await blocking(fill.abort)
+            await self.end(FAILED)
+        finally:
+            origin.close()
+
+    async def resume(self):
+        """
+        Asks the origin for the rest of a download that was cut off, if the
+        file hasn't changed. Returns the new response, or None if the origin
+        can't serve ranges or it's been tried too often.
+        """
+        fill = self.fill
+        if not fill.validator or fill.size is None or \
+                not self.accepts_ranges or self.resumes >= MAX_RESUMES:
+            return None
+        self.resumes += 1
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={0}-{1}'.format(fill.written, fill.size - 1)
+        headers['If-Range'] = fill.validator
+        try:
+            origin = await open_origin(self.url, headers)
+        except Exception:
+            return None
+        if origin.code == 206 and \
+                get_header(origin.headers, 'content-range') == \
+                content_range(fill.written, fill.size - 1, fill.size) and \
+                validator(origin.headers) in (None, fill.validator):
+            return origin
+        origin.close()
+        return None
+
+    async def end(self, state):
+        """Marks the fill as over, waking anyone following it."""
+        if _FILLS.get(self.fill.key) is self:
+            del _FILLS[self.fill.key]
+        async with self.cond:
+            if self.state not in (DONE, FAILED):
+                self.state = state
+            self.cond.notify_all()
+
+    async def wait_started(self):
+        """Waits until the fill has a response from the origin, or fails."""
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.state != PENDING)
+            return self.state
+
+    async def wait_for(self, offset):
+        """
+        Waits until there's data past `offset` or the fill is over. Returns
+        how much has been written, and the fill's state.
+        """
+        async with self.cond:
+            await self.cond.wait_for(
+                lambda: self.fill.written > offset or
+                self.state not in (PENDING, STREAMING))
+            return self.fill.written, self.state
+
+    async def body(self):
+        """Yields the file as it lands on disk."""
+        t_file = await blocking(self.fill.open_for_reading)
+        try:
+            fd = t_file.fileno()
+            offset = 0
+            while True:
+                end, state = await self.wait_for(offset)
+                if end > offset:
+                    data = await read_at(fd, min(CHUNK_SIZE, end - offset),
+                                         offset)
+                    if not data:
+                        return
+                    offset += len(data)
+                    yield data
+                elif state != STREAMING:
+                    return
+        finally:
+            t_file.close()
+
+
+class Client(object):
+    """The client's end of a request: what it asked for, and the response."""
+    def __init__(self, scope, receive, send):
+        self.receive = receive
+        self.send = send
+        self.gone = False
+        self.headers = {}
+        for key, value in scope['headers']:
+            key, value = key.decode('latin-1').lower(), value.decode('latin-1')
+            if key in self.headers:
+                value = self.headers[key] + ", " + value
+            self.headers[key] = value
+
+    @property
+    def origin_headers(self):
+        """The request headers to forward to an origin."""
+        return {key: self.headers[key] for key in self.headers
+                if key != 'host' and key not in HOP_BY_HOP}
+
+    async def watch(self):
+        """Notices the client hanging up, so the response can stop."""
+        while True:
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                self.gone = True
+                return
+
+    async def respond(self, status, headers, filename=None, body=None):
+        """
+        Sends the response: `status`, `headers` (a dict; None values are
+        left out) with a Content-Disposition naming `filename` unless there
+        is one already, and the chunks `body` yields, for as long as the
+        client's there.
+        """
+        if filename and not get_header(headers, 'content-disposition'):
+            headers = dict(headers)
+            headers['Content-Disposition'] = \
+                'inline; filename="{0}"'.format(filename)
+        await self.send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(key.encode('latin-1'), str(value).encode('latin-1'))
+                        for key, value in headers.items() if value is not None]
+        })
+        if body is not None:
+            try:
+                async for data in body:
+                    if self.gone:
+                        break
+                    await self.send({'type': 'http.response.body',
+                                     'body': data, 'more_body': True})
+            finally:
+                await body.aclose()
+        await self.send({'type': 'http.response.body', 'body': b""})
+
+
+async def read_file(t_file, offset, length):
+    """Yields `length` bytes of the open file `t_file` from `offset`."""
+    fd = t_file.fileno()
+    while length > 0:
+        data = await read_at(fd, min(CHUNK_SIZE, length), offset)
+        if not data:
+            return
+        offset += len(data)
+        length -= len(data)
+        yield data
+
+
+async def read_parts(t_file, multipart):
+    """Yields a multipart/byteranges body, its parts read from `t_file`."""
+    for first, last in multipart.ranges:
+        yield multipart.part_header(first, last).encode('latin-1')
+        async for data in read_file(t_file, first, last - first + 1):
+            yield data
+    yield multipart.closing.encode('latin-1')
+
+
+def record(file_id, code, headers):
+    """Counts a download of `file_id`, if it's being served."""
+    if file_id is not None and code in (200, 206):
+        accounting.ACCOUNTING.record(file_id, content_length(headers) or 0)
+
+
+async def pass_through(client, origin, filename, file_id=None):
+    """Streams an origin's response to the client, as ProxyResponse does."""
+    try:
+        if origin.code >= 400:
+            # Just the status, like the threaded engine's HTTPError.
+            await client.respond(origin.code, {}, filename)
+            return
+        headers = passed_headers(origin.headers)
+        record(file_id, origin.code, headers)
+        await client.respond(origin.code, headers, filename, origin.body())
+    finally:
+        origin.close()
+
+
+async def fetch(client, url, filename, file_id=None, headers=None):
+    """Passes `url` through to the client, or a 502 if it can't be had."""
+    try:
+        origin = await open_origin(
+            url, client.origin_headers if headers is None else headers)
+    except Exception as err:
+        print("Couldn't reach the origin:", err)
+        await client.respond(502, {})
+        return
+    await pass_through(client, origin, filename, file_id)
+
+
+async def serve_cached(client, file_id, t_file, path):
+    """Serves a cached file, or the ranges of it asked for."""
+    size = os.fstat(t_file.fileno()).st_size
+    mimetype = mimetypes.guess_type(path)[0]
+    filename = os.path.basename(path)
+    headers = {'Accept-Ranges': 'bytes', 'Content-Type': mimetype}
+    try:
+        ranges = parse_range_header(client.headers.get('range'), size)
+    except RangeNotSatisfiable:
+        headers = {'Accept-Ranges': 'bytes', 'Content-Length': 0,
+                   'Content-Range': unsatisfiable_range(size)}
+        await client.respond(416, headers, filename)
+        return
+
+    if ranges and len(ranges) == 1:
+        first, last = ranges[0]
+        code = 206
+        headers['Content-Length'] = last - first + 1
+        headers['Content-Range'] = content_range(first, last, size)
+        body = read_file(t_file, first, last - first + 1)
+    elif ranges:
+        multipart = MultipartByteranges(ranges, size, mimetype)
+        code = 206
+        headers['Content-Type'] = multipart.content_type
+        headers['Content-Length'] = multipart.content_length
+        body = read_parts(t_file, multipart)
+    else:
+        code = 200
+        headers['Content-Length'] = size
+        body = read_file(t_file, 0, size)
+    record(file_id, code, headers)
+    await client.respond(code, headers, filename, body)
+
+
+async def serve_uncached(client, file_id, url):
+    """
+    Serves a file that isn't cached from its origin, filling the cache on
+    the way, or following a fill that's already running.
+    """
+    filename = url_filename(url)
+    fill, created = AsyncFill.join_or_create(url, CONFIG,
+                                             client.origin_headers)
+    if created:
+        try:
+            origin = await open_origin(url, client.origin_headers)
+        except Exception as err:
+            print("Couldn't reach the origin:", err)
+            await fill.end(FAILED)
+            await client.respond(502, {})
+            return
+        if not await fill.start(origin):
+            # Can't be cached, or someone else is caching it.
+            await pass_through(client, origin, filename, file_id)
+            return
+    elif await fill.wait_started() == FAILED:
+        # The fill never got going, so fetch it without one.
+        await fetch(client, url, filename, file_id)
+        return
+    record(file_id, fill.response_code, fill.response_headers)
+    await client.respond(fill.response_code, fill.response_headers,
+                         filename, fill.body())
+
+
+async def serve_file_id(client, entry):
+    """Serves a link, from the cache if it can, as CacheResponse does."""
+    file_id = entry['file_id']
+    local_path = entry['local_location']
+    remote_url = entry['remote_location']
+    if not local_path and remote_url:
+        # Another link to the same file may already have cached it.
+        local_path = await blocking(
+            database.AlchemyDatabase().link_object, file_id,
+            object_key(remote_url))
+
+    t_file = None
+    if local_path:
+        headers = offload.offload_headers(local_path, CONFIG)
+        if headers:
+            # The front-end server sends the file itself.
+            try:
+                size = os.path.getsize(local_path)
+            except OSError:
+                size = None
+            if size is not None:
+                CACHE.offloaded(local_path)
+                accounting.ACCOUNTING.record(file_id, size)
+                await client.respond(200, headers,
+                                     os.path.basename(local_path))
+                return
+        else:
+            # Held open until it's been served, so it isn't evicted.
+            t_file = await blocking(CACHE.open, local_path)
+        if t_file is None:
+            print("Cached file was evicted.")
+
+    if t_file is None:
+        if not remote_url:
+            await client.respond(404, {}, body=one_chunk(b"404"))
+            return
+        await serve_uncached(client, file_id, remote_url)
+        return
+    try:
+        await serve_cached(client, file_id, t_file, local_path)
+    finally:
+        t_file.close()
+
+
+async def one_chunk(data):
+    """Yields `data`."""
+    yield data
+
+
+async def serve(client, path):
+    """
+    Works out what's asked for, as app.caching_proxy does, and serves it: a
+    direct URL is streamed from its origin, a file_id from the cache, and
+    anything else gets a 404.
+    """
+    if path.startswith(MOUNT + '/'):
+        path = path[len(MOUNT):]
+    request_value = path[1:]
+    if "://" in request_value:
+        url = encode_url(request_value)
+        await fetch(client, url, url_filename(url))
+        return
+    entry = await blocking(database.AlchemyDatabase().get_entry,
+                           request_value)
+    if entry:
+        await serve_file_id(client, entry)
+    else:
+        await client.respond(404, {}, body=one_chunk(b"404"))
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    client = Client(scope, receive, send)
+    watcher = asyncio.ensure_future(client.watch())
+    try:
+        await serve(client, scope['path'])
+    finally:
+        watcher.cancel()
+
+
+def configure(config):
+    """
+    Sets up what the engine shares with the threaded one, from the config,
+    and the pool of threads for blocking work.
+    """
+    global IO_POOL
+    database.init_database(
+        entry_cache_size=config.entry_cache_size,
+        entry_cache_max_age=config.entry_cache_max_age,
+        file_id_length=config.file_id_length,
+        file_id_alphabet=config.file_id_alphabet
+    )
+    cache_manager.configure(config)
+    accounting.configure(config)
+    IO_POOL = ThreadPoolExecutor(config.async_io_threads)
+
+
+CONFIG = database.ConfigReader()
+configure(CONFIG)
+
+APPLICATION = application
+
+
+def benchmark(url, clients=1000, pid=None):
+    """
+    Downloads `url` with `clients` requests at once, and reports how long it
+    took, the throughput and the time to first byte. If `pid` is the
+    server's, its peak thread count and memory are reported too. Point it at
+    either engine, for the same file, to compare them; e.g. app.py under
+    `run_simple(..., threaded=True)` and this one under uvicorn.
+    """
+    peaks = {'Threads': 0, 'VmRSS': 0}
+    first_bytes = []
+    failures = []
+    received = [0]
+
+    async def download():
+        started = time.time()
+        try:
+            origin = await open_origin(url, {}, timeout=60)
+            try:
+                if origin.code not in (200, 206):
+                    raise IOError("Got a {0}".format(origin.code))
+                first = True
+                async for data in origin.body():
+                    if first:
+                        first_bytes.append(time.time() - started)
+                        first = False
+                    received[0] += len(data)
+            finally:
+                origin.close()
+        except Exception as err:
+            failures.append(err)
+
+    async def sample():
+        while True:
+            try:
+                with open('/proc/{0}/status'.format(pid)) as status:
+                    for line in status:
+                        key, _, value = line.partition(':')
+                        if key in peaks:
+                            peaks[key] = max(peaks[key],
+                                             int(value.split()[0]))
+            except (IOError, ValueError):
+                return
+            await asyncio.sleep(0.05)
+
+    async def run():
+        sampler = asyncio.ensure_future(sample()) if pid else None
+        await asyncio.gather(*[download() for _ in range(clients)])
+        if sampler is not None:
+            sampler.cancel()
+
+    started = time.time()
+    asyncio.get_event_loop().run_until_complete(run())
+    elapsed = time.time() - started
+
+    first_bytes.sort()
+    print("{0} clients, {1} failed, {2:.1f} MB in {3:.2f}s ({4:.1f} MB/s)"
+          .format(clients, len(failures), received[0] / 1048576.0, elapsed,
+                  received[0] / 1048576.0 / elapsed))
+    if first_bytes:
+        print("First byte: median {0:.0f} ms, 99th percentile {1:.0f} ms"
+              .format(first_bytes[len(first_bytes) // 2] * 1000,
+                      first_bytes[int(len(first_bytes) * 0.99)] * 1000))
+    if pid:
+        print("Server peak: {0} threads, {1:.0f} MB resident"
+              .format(peaks['Threads'], peaks['VmRSS'] / 1024.0))
+    if failures:
+        print("First failure:", repr(failures[0]))
+
+
+if __name__ == '__main__':
+    # Run a development server
+    import uvicorn
+    uvicorn.run(APPLICATION, host='localhost', port=5001)
@@ -0,0 +1,270 @@
+from __future__ import print_function
+import threading
+import resource
+import time
+
+# Chunk size is 0.5 megabytes
+CHUNK_SIZE = 524288
+
+
+def read_into(stream, view):
+    """
+    Fills as much of the writable `view` as one read of `stream` allows,
+    returning the number of bytes read (0 at end of stream). Streams without
+    `readinto`, like urllib2 responses, are read and copied into the view.
+    """
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is not None:
+        return readinto(view) or 0
+    data = stream.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
+
+class BufferPool(object):
+    """
+    A capped pool of reusable, fixed-size bytearrays used for reading chunks
+    of files. At most `max_buffers` buffers ever exist at once; `acquire`
+    blocks until one is released, so chunk memory stays bounded no matter how
+    many downloads are running.
+    """
+    def __init__(self, buffer_size=CHUNK_SIZE, max_buffers=64):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self.created = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self._free = []
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Returns a buffer from the pool, blocking while the pool is exhausted."""
+        with self._cond:
+            while not self._free and self.created >= self.max_buffers:
+                self._cond.wait()
+            if self._free:
+                buf = self._free.pop()
+            else:
+                buf = bytearray(self.buffer_size)
+                self.created += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return buf
+
+    def release(self, buf):
+        """Returns `buf` to the pool."""
+        with self._cond:
+            self.in_use -= 1
+            if self.created > self.max_buffers or len(buf) != self.buffer_size:
+                # The pool was shrunk (or resized) while this was out.
+                self.created -= 1
+            else:
+                self._free.append(buf)
+            self._cond.notify()
+
+    def chunks(self, stream, length=None):
+        """
+        Reads `stream`, or at most `length` bytes of it, into pooled buffers
+        and yields a memoryview of each filled chunk. A chunk's buffer goes back
+        to the pool when the next chunk is asked for, so callers must be done
+        with a view before advancing the generator.
+        """
+        buf = self.acquire()
+        try:
+            view = memoryview(buf)
+            while length is None or length > 0:
+                want = len(buf) if length is None else min(length, len(buf))
+                read = read_into(stream, view[:want])
+                if not read:
+                    break
+                if length is not None:
+                    length -= read
+                yield view[:read]
+        finally:
+            self.release(buf)
+
+    def stats(self):
+        """Reports pool occupancy, and the peak resident memory of the process."""
+        with self._cond:
+            return {
+                'buffer_size': self.buffer_size,
+                'max_buffers': self.max_buffers,
+                'created': self.created,
+                'in_use': self.in_use,
+                'free': len(self._free),
+                'peak_in_use': self.peak_in_use,
+                # ru_maxrss is in kilobytes on Linux.
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            }
+
+
+class RingBuffer(object):
+    """
+    A bounded buffer that hands a stream from one producer thread to one
+    consumer thread, holding at most `capacity` bytes (rounded up to whole
+    buffers) in buffers taken from `pool`. Its memory is therefore part of
+    the pool's cap, however many of these there are.
+
+    The producer reads straight into free space (`writable`, then `commit`)
+    and the consumer copies out what's there (`read`). Each waits on a
+    condition variable that the other notifies as soon as it's made
+    progress: the consumer wakes the moment data, the end of the stream
+    (`finish`) or a hang-up (`close`) arrives, and the producer wakes the
+    moment there's room. A consumer that makes no room for too long is
+    timed by a Timer that only runs while the producer is stuck.
+    """
+    def __init__(self, capacity=1048576, pool=None):
+        self.pool = pool or CHUNK_POOL
+        self.max_buffers = max(1, -(-capacity // self.pool.buffer_size))
+        self.finished = False
+        self.closed = False
+        # [buffer, bytes written] for each buffer, oldest first. Every buffer
+        # but the last is full.
+        self._buffers = []
+        self._offset = 0
+        self._size = 0
+        self._writing = False
+        self._stalled_since = None
+        self._timer = None
+        self._cond = threading.Condition()
+
+    def writable(self, limit=None, timeout=None):
+        """
+        Waits for free space and returns a writable memoryview of as much of
+        it as is contiguous, at most `limit` bytes, for the producer to fill
+        and then `commit`. Returns None once the buffer's closed, which it
+        is if the consumer makes no room within `timeout` seconds.
+        """
+        with self._cond:
+            view = self._free_space(limit, timeout)
+            if view is not None or self.closed:
+                return view
+        # Only waits, if at all, for the pool; the consumer can carry on.
+        buf = self.pool.acquire()
+        with self._cond:
+            if self.closed:
+                self.pool.release(buf)
+                return None
+            self._buffers.append([buf, 0])
+            return self._free_space(limit, timeout)
+
+    def _free_space(self, limit, timeout):
+        """
+        Waits, holding the lock, until the last buffer has room or another
+        one can be added. Returns a view of the room, or None if a buffer
+        needs adding or the consumer's gone.
+        """
+        while not self.closed:
+            buf, written = self._buffers[-1] if self._buffers else (b"", 0)
+            if written < len(buf):
+                stop = len(buf)
+                if limit is not None:
+                    stop = min(stop, written + limit)
+                self._writing = True
+                self._stalled_since = None
+                return memoryview(buf)[written:stop]
+            if len(self._buffers) < self.max_buffers:
+                self._stalled_since = None
+                return None
+            if timeout is not None and self._stalled_since is None:
+                self._stalled_since = time.time()
+                if self._timer is None:
+                    self._start_timer(timeout, timeout)
+            self._cond.wait()
+        return None
+
+    def _start_timer(self, delay, timeout):
+        """Checks on the stalled producer in `delay` seconds."""
+        self._timer = threading.Timer(delay, self._check_stall, (timeout,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _check_stall(self, timeout):
+        """
+        Closes the buffer if the producer's been stuck for `timeout` seconds,
+        or waits for the rest of that time if it got going and stalled again
+        since the timer was started.
+        """
+        with self._cond:
+            self._timer = None
+            if self._stalled_since is None or self.closed:
+                return
+            left = self._stalled_since + timeout - time.time()
+            if left > 0:
+                self._start_timer(left, timeout)
+                return
+        self.close()
+
+    def _release(self, keep_last):
+        """Hands the buffers back to the pool, bar the one being written."""
+        keep = self._buffers[-1:] if keep_last and self._buffers else []
+        for buf, _ in self._buffers[:len(self._buffers) - len(keep)]:
+            self.pool.release(buf)
+        self._buffers = keep
+        self._offset = 0
+        self._size = 0
+
+    def commit(self, count):
+        """Makes `count` bytes written to the last `writable` view readable."""
+        with self._cond:
+            self._writing = False
+            if self.closed:
+                self._release(False)
+            else:
+                self._buffers[-1][1] += count
+                self._size += count
+            self._cond.notify_all()
+
+    def finish(self):
+        """Marks the end of the stream; the consumer reads what's left."""
+        with self._cond:
+            self.finished = True
+            self._writing = False
+            if self.closed:
+                self._release(False)
+            self._cond.notify_all()
+
+    def close(self):
+        """Discards what's buffered, and stops the producer, for good."""
+        with self._cond:
+            self.closed = True
+            self._release(self._writing)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._cond.notify_all()
+
+    def read(self, size):
+        """
+        Waits for data and returns at most `size` bytes of it, or b"" once
+        the stream's finished and read, or the buffer's closed.
+        """
+        with self._cond:
+            while not self._size and not self.finished and not self.closed:
+                self._cond.wait()
+            if not self._size:
+                return b""
+            buf, written = self._buffers[0]
+            count = min(size, written - self._offset)
+            data = memoryview(buf)[self._offset:self._offset + count].tobytes()
+            self._offset += count
+            self._size -= count
+            if self._offset == len(buf):
+                # Full and read, so the producer's done with it.
+                self.pool.release(self._buffers.pop(0)[0])
+                self._offset = 0
+            self._cond.notify_all()
+            return data
+
+
+# The pool shared by every response in the process.
+CHUNK_POOL = BufferPool()
+
+def configure(max_buffers):
+    """Sets the cap on the number of buffers in the shared pool."""
+    with CHUNK_POOL._cond:
+        CHUNK_POOL.max_buffers = max_buffers
+        while CHUNK_POOL._free and CHUNK_POOL.created > max_buffers:
+            CHUNK_POOL._free.pop()
+            CHUNK_POOL.created -= 1
+        CHUNK_POOL._cond.notify_all()
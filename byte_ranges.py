@@ -0,0 +1,167 @@
+from __future__ import print_function
+from buffer_pool import CHUNK_POOL
+import binascii
+import os
+
+# Requests asking for more ranges than this are served the whole file, rather
+# than letting a client make us assemble thousands of tiny parts.
+MAX_RANGES = 64
+
+
+class RangeNotSatisfiable(ValueError):
+    """Raised when none of the requested ranges overlap the file."""
+    pass
+
+
+def parse_range_header(range_header, size):
+    """
+    Parses an RFC 7233 `Range` header against a file of `size` bytes.
+
+    Returns a list of `(first, last)` byte positions (inclusive), or None if
+    there's no header, or it's malformed or in a unit other than bytes, in
+    which case the whole file should be served. Handles open-ended (`500-`),
+    suffix (`-500`) and multiple ranges; overlapping or adjacent ranges are
+    merged. Raises RangeNotSatisfiable if no range overlaps the file.
+    """
+    if not range_header:
+        return None
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    specs = [spec.strip() for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first.isdigit() or first == '') or \
+           not (last.isdigit() or last == '') or (not first and not last):
+            return None
+        if not first:
+            # Suffix range: the last N bytes of the file.
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first >= size:
+            continue
+        last = int(last) if last else size - 1
+        ranges.append((first, min(last, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable(
+            "None of the requested ranges are within the file.")
+    return coalesce(ranges)
+
+
+def coalesce(ranges):
+    """
+    Merges overlapping or adjacent ranges. Ranges that don't touch are left
+    in the order the client asked for them.
+    """
+    ordered = sorted(ranges)
+    if all(ordered[i][1] + 1 < ordered[i + 1][0]
+           for i in range(len(ordered) - 1)):
+        return list(ranges)
+    merged = [ordered[0]]
+    for first, last in ordered[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def content_range(first, last, size):
+    """Formats a `Content-Range` header value."""
+    return 'bytes {0}-{1}/{2}'.format(first, last, size)
+
+
+def unsatisfiable_range(size):
+    """The `Content-Range` header value sent along with a 416."""
+    return 'bytes */{0}'.format(size)
+
+
+class FileSlice(object):
+    """
+    A read-only, file-like view of `length` bytes of an open file, starting at
+    the file's current position. It's meant to be handed to
+    `wsgi.file_wrapper` for ranged responses.
+
+    It deliberately has no `fileno`: servers that sendfile a wrapped file
+    would otherwise send everything up to the end of the file, not just the
+    slice.
+    """
+    def __init__(self, t_file, length):
+        self.t_file = t_file
+        self.remaining = length
+
+    def read(self, size=-1):
+        """Reads at most `size` bytes, never going past the end of the slice."""
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return b""
+        data = self.t_file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        """Closes the underlying file."""
+        self.t_file.close()
+
+
+class MultipartByteranges(object):
+    """
+    A `multipart/byteranges` body for several ranges of one file. The parts
+    are streamed straight from the file, and the total length is known up
+    front so it can be sent as `Content-Length`.
+    """
+    def __init__(self, ranges, size, part_type=None, boundary=None):
+        self.ranges = ranges
+        self.size = size
+        self.part_type = part_type or 'application/octet-stream'
+        self.boundary = boundary or \
+            str(binascii.hexlify(os.urandom(12)).decode('ascii'))
+
+    @property
+    def content_type(self):
+        """The `Content-Type` of the whole response."""
+        return 'multipart/byteranges; boundary={0}'.format(self.boundary)
+
+    def part_header(self, first, last):
+        """The delimiter and headers that come before one part."""
+        return ('\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: {2}\r\n\r\n'
+                .format(self.boundary, self.part_type,
+                        content_range(first, last, self.size)))
+
+    @property
+    def closing(self):
+        """The final delimiter."""
+        return '\r\n--{0}--\r\n'.format(self.boundary)
+
+    @property
+    def content_length(self):
+        """The length of the whole body, in bytes."""
+        total = len(self.closing)
+        for first, last in self.ranges:
+            total += len(self.part_header(first, last)) + last - first + 1
+        return total
+
+    def iter_file(self, t_file):
+        """Yields the body, reading each part from `t_file` in pooled chunks."""
+        try:
+            for first, last in self.ranges:
+                yield self.part_header(first, last)
+                t_file.seek(first)
+                for chunk in CHUNK_POOL.chunks(t_file, last - first + 1):
+                    yield chunk.tobytes()
+            yield self.closing
+        finally:
+            t_file.close()
@@ -0,0 +1,498 @@
+from __future__ import print_function
+from segment_cache import segment_map, open_partial
+from buffer_pool import CHUNK_POOL
+from cache_manager import CACHE
+from cache_store import ContentHasher, object_key, object_location,\
+    expected_digests
+import threading
+import time
+try:
+    import urllib2
+except ImportError:
+    # Python 3, which async_proxy runs on.
+    import urllib.request as urllib2
+import os.path
+import os
+
+# The states a fill moves through. A fill is PENDING until it has the entry's
+# lock and a response from the origin, STREAMING while bytes are landing on
+# disk, and then either DONE or FAILED.
+PENDING = "pending"
+STREAMING = "streaming"
+DONE = "done"
+FAILED = "failed"
+
+# Fills currently running in this process, by cached object key, so that
+# concurrent requests for the same file, through any of its links, can follow
+# one fill instead of starting their own.
+_ACTIVE_FILLS = {}
+_ACTIVE_LOCK = threading.Lock()
+
+# How many times a fill asks the origin for the rest of a download that was
+# cut off before giving up on it.
+MAX_RESUMES = 3
+
+
+class OriginChanged(IOError):
+    """Raised when the origin's file is no longer the one being cached."""
+    pass
+
+
+def cache_location(url, config):
+    """Where the file at `url` is kept in the cache directory."""
+    return object_location(url, config.cache)
+
+
+def get_header(headers, name):
+    """Looks up a header in a dict of response headers, ignoring case."""
+    for key in headers:
+        if key.lower() == name:
+            return headers[key]
+    return None
+
+
+def content_length(headers):
+    """The Content-Length in a dict of response headers, or None."""
+    try:
+        return int(get_header(headers, 'content-length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def validator(headers):
+    """
+    What identifies the version of the file in a response, for If-Range: its
+    ETag if that's a strong one, or else its Last-Modified date. None if the
+    response has neither.
+    """
+    etag = get_header(headers, 'etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return get_header(headers, 'last-modified')
+
+
+def open_range(url, headers, first, last, size, check=None):
+    """
+    Requests bytes `first` through `last` of the file at `url`, which is
+    `size` bytes long, and returns the open response. If `check`, the
+    validator of the copy being cached, is given, the range is only asked for
+    if the file is still that version, and OriginChanged is raised if it
+    isn't. Raises IOError if the origin doesn't return the range asked for.
+    """
+    headers = dict(headers)
+    headers['Range'] = 'bytes={0}-{1}'.format(first, last)
+    if check:
+        headers['If-Range'] = check
+    opener = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=3)
+    code = opener.getcode()
+    info = dict(opener.info())
+    received = validator(info)
+    if code == 206 and get_header(info, 'content-range') == \
+            'bytes {0}-{1}/{2}'.format(first, last, size):
+        if not check or received in (None, check):
+            return opener
+    opener.close()
+    if check and (code == 200 or received not in (None, check)):
+        raise OriginChanged("The file at the origin has changed.")
+    raise IOError("Origin didn't return the requested range.")
+
+
+def probe_origin(url, headers=None):
+    """
+    Asks the origin about the file at `url` with a HEAD request. Returns the
+    response's headers (with lower-case names), or None if the origin
+    couldn't be reached or didn't answer with a 200.
+    """
+    request = urllib2.Request(url, headers=headers or {})
+    request.get_method = lambda: 'HEAD'
+    try:
+        opener = urllib2.urlopen(request, timeout=3)
+    except Exception:
+        return None
+    try:
+        if opener.getcode() != 200:
+            return None
+        return {key.lower(): value for key, value in opener.info().items()}
+    finally:
+        opener.close()
+
+
+def store_object(db, url, segments, location, hasher):
+    """
+    Checks a completely fetched partial file against the origin's digests,
+    then moves it into place as the cached object for `url` and links every
+    entry for `url` to it. A file that doesn't match is thrown away, and
+    IOError raised.
+    """
+    segments.discard()
+    if not hasher.verify():
+        os.remove(segments.path)
+        raise IOError("Fetched file doesn't match the origin's digest.")
+    os.rename(segments.path, location)
+    db.store_object(object_key(url), url, location,
+                    os.path.getsize(location), hasher.content_hash)
+    CACHE.added(location)
+
+
+def finish_from_segments(url, config):
+    """
+    Moves a partial file whose segments have all been fetched into place as
+    the cached object for `url`. Does nothing if a fill holds the object's
+    lease, since that fill will finish it instead.
+    """
+    import database
+    key = object_key(url)
+    location = cache_location(url, config)
+    segments = segment_map(location + ".part")
+    db = database.AlchemyDatabase()
+    owner = database.lease_owner()
+    try:
+        try:
+            db.acquire_lease(key, owner, config.fill_lease_ttl)
+        except RuntimeError:
+            return
+        try:
+            if segments.is_complete and os.path.exists(segments.path):
+                hasher = ContentHasher()
+                hasher.update_from_file(segments.path, CHUNK_POOL.chunks)
+                store_object(db, url, segments, location, hasher)
+        finally:
+            db.release_lease(key, owner)
+    finally:
+        database.remove_session()
+
+
+def active_fill(url):
+    """Returns the fill running in this process for `url`, or None."""
+    with _ACTIVE_LOCK:
+        return _ACTIVE_FILLS.get(object_key(url))
+
+
+class CacheFill(object):
+    """
+    Writes a file being fetched from its remote location into the cache
+    directory, and once it's complete and matches any digest the origin gave,
+    stores it as a cached object shared by every entry for that URL. Only one
+    fill per object runs at a time, guarded by a lease on the object that the
+    fill renews as it makes progress, and within a process other requests can
+    follow its progress on disk.
+    """
+    # Whether the content is hashed as it's written. Fills that write out of
+    # order hash the file once it's complete instead.
+    hash_as_written = True
+
+    def __init__(self, url, config):
+        self.url = url
+        self.key = object_key(url)
+        self.location = cache_location(url, config)
+        # Written under a temporary name so a half-written file is never
+        # mistaken for a complete one. Range requests may already have put
+        # some segments of it there.
+        self.partial_location = self.location + ".part"
+        self.segments = segment_map(self.partial_location)
+        self.cache_file = None
+        self.db = None
+        self.owner = None
+        self.lease_ttl = config.fill_lease_ttl
+        self.renewed = None
+        self.renewed_written = 0
+        self.hasher = None
+
+        self.state = PENDING
+        self.written = 0
+        self.size = None
+        self.validator = None
+        self.response_code = None
+        self.response_headers = None
+        self.cond = threading.Condition()
+
+    @classmethod
+    def join_or_create(cls, url, config, **kwargs):
+        """
+        Returns `(fill, created)`: the fill already running in this process
+        for `url`, or a new, registered one that the caller must drive.
+        """
+        with _ACTIVE_LOCK:
+            fill = _ACTIVE_FILLS.get(object_key(url))
+            if fill is not None:
+                return fill, False
+            fill = cls(url, config, **kwargs)
+            _ACTIVE_FILLS[fill.key] = fill
+            return fill, True
+
+    def start(self, response_code=200, response_headers=None):
+        """
+        Takes the object's lease and opens the cache file, given the origin's
+        response. Returns False, and fails the fill, if another fill already
+        holds the lease.
+        """
+        import database
+        self.db = database.AlchemyDatabase()
+        owner = database.lease_owner()
+        try:
+            self.db.acquire_lease(self.key, owner, self.lease_ttl)
+        except RuntimeError:
+            self.abort()
+            return False
+        self.owner = owner
+        self.renewed = time.time()
+        response_headers = response_headers or {}
+        self.size = content_length(response_headers)
+        self.validator = validator(response_headers)
+        self.hasher = ContentHasher(expected_digests(response_headers))
+        try:
+            CACHE.make_room(self.size or 0)
+            self.segments.reset(content_length(response_headers),
+                get_header(response_headers, 'content-type'), self.validator)
+            # Unbuffered, so that followers reading the file see every chunk
+            # as soon as it's written. Not truncated, since any segments
+            # already there are still good.
+            self.cache_file = open_partial(self.partial_location)
+        except Exception:
+            self.abort()
+            raise
+        with self.cond:
+            self.response_code = response_code
+            self.response_headers = response_headers
+            self.state = STREAMING
+            self.cond.notify_all()
+        return True
+
+    def write(self, chunk):
+        """Appends a chunk to the cache file."""
+        self.cache_file.write(chunk)
+        self.hasher.update(chunk)
+        self.segments.add(self.written, self.written + len(chunk) - 1)
+        with self.cond:
+            self.written += len(chunk)
+            self.cond.notify_all()
+        self.heartbeat()
+
+    def heartbeat(self):
+        """
+        Renews the lease every third of its lifetime, as long as the fill has
+        written something since the last renewal; a stalled fill lets it
+        lapse. Raises RuntimeError if another worker has taken it over.
+        """
+        now = time.time()
+        if now - self.renewed < self.lease_ttl / 3.0 or \
+                self.written == self.renewed_written:
+            return
+        self.db.renew_lease(self.key, self.owner, self.lease_ttl)
+        self.renewed, self.renewed_written = now, self.written
+
+    def finish(self):
+        """Checks the complete file and stores it as a cached object."""
+        import database
+        try:
+            self.cache_file.close()
+            if not self.hash_as_written:
+                self.hasher.update_from_file(self.partial_location,
+                                             CHUNK_POOL.chunks)
+            # Makes sure the file is still ours to move into place.
+            self.db.renew_lease(self.key, self.owner, self.lease_ttl)
+            store_object(self.db, self.url, self.segments, self.location,
+                         self.hasher)
+        except Exception:
+            self._end(FAILED)
+            raise
+        finally:
+            if self.owner is not None:
+                self.db.release_lease(self.key, self.owner)
+            database.remove_session()
+        self._end(DONE)
+
+    def abort(self):
+        """
+        Gives up on a fill that couldn't be completed, or never started. What
+        was written is kept as a segment of the partial file.
+        """
+        import database
+        try:
+            if self.cache_file is not None:
+                self.cache_file.close()
+                self.segments.save()
+        finally:
+            try:
+                if self.owner is not None:
+                    self.db.release_lease(self.key, self.owner)
+            finally:
+                database.remove_session()
+                self._end(FAILED)
+
+    def _end(self, state):
+        """Marks the fill as over, waking anyone following it."""
+        with _ACTIVE_LOCK:
+            if _ACTIVE_FILLS.get(self.key) is self:
+                del _ACTIVE_FILLS[self.key]
+        with self.cond:
+            if self.state not in (DONE, FAILED):
+                self.state = state
+            self.cond.notify_all()
+
+    def open_for_reading(self):
+        """
+        Opens the file being filled, wherever it currently is. Unbuffered:
+        a buffered read runs ahead of what's been written, into the holes of
+        a partial file, and a later seek back into that buffer would serve
+        them instead of what's since been written there.
+        """
+        try:
+            return open(self.partial_location, 'rb', 0)
+        except IOError:
+            # It was moved into place in the meantime.
+            return open(self.location, 'rb', 0)
+
+    def readable_end(self, offset):
+        """
+        Where the data that can be read from `offset` without a gap ends. A
+        sequential fill has everything up to what it's written.
+        """
+        return self.written
+
+    def wait_for(self, offset):
+        """
+        Blocks until there's data past `offset` or the fill is over. Returns
+        where the readable data from `offset` ends, and the fill's state.
+        """
+        with self.cond:
+            while self.readable_end(offset) <= offset and \
+                    self.state in (PENDING, STREAMING):
+                self.cond.wait()
+            return self.readable_end(offset), self.state
+
+    def wait_started(self):
+        """Blocks until the fill has a response from the origin, or fails."""
+        with self.cond:
+            while self.state == PENDING:
+                self.cond.wait()
+            return self.state
+
+
+# Response headers from the origin's HEAD that are passed on to clients of a
+# parallel fill; the rest describe the HEAD itself, or the connection.
+PASSED_HEADERS = ('content-length', 'content-type', 'last-modified', 'etag',
+                  'digest', 'content-md5')
+
+
+class ParallelFill(CacheFill):
+    """
+    Fills the cache over several connections at once, each downloading its
+    own byte range of the file into the partial file at the right offset. It
+    needs an origin that supports ranges, and is only used for hosts set up
+    for it in the config (see ConfigReader.parallel_fill_for). Clients read
+    it through a FillFollower, which waits for the bytes at its position to
+    arrive, whichever connection they come from.
+    """
+    hash_as_written = False
+
+    def __init__(self, url, config, info=None, headers=None,
+                 connections=4, min_segment_bytes=8388608):
+        super(ParallelFill, self).__init__(url, config)
+        self.info = info or {}
+        self.headers = headers or {}
+        self.connections = max(1, connections)
+        self.min_segment_bytes = max(1, min_segment_bytes)
+
+    def readable_end(self, offset):
+        """Segments land out of order, so only count what's contiguous."""
+        if self.state == DONE:
+            # The segment map is gone once the file is in place.
+            return self.size
+        return offset + self.segments.contiguous_from(offset)
+
+    def missing(self, first, last):
+        """The pieces of bytes `first` through `last` that aren't on disk."""
+        return [(piece_first, piece_last) for piece_first, piece_last, on_disk
+                in self.segments.pieces(first, last) if not on_disk]
+
+    def plan(self):
+        """Splits the parts of the file not yet on disk into segments."""
+        missing = self.missing(0, self.size - 1)
+        total = sum(last - first + 1 for first, last in missing)
+        segment_bytes = max(self.min_segment_bytes,
+                            -(-total // self.connections))
+        segments = []
+        for first, last in missing:
+            while first <= last:
+                end = min(first + segment_bytes - 1, last)
+                segments.append((first, end))
+                first = end + 1
+        return segments
+
+    def fetch_segment(self, first, last):
+        """Downloads bytes `first` through `last` into the partial file."""
+        opener = open_range(self.url, self.headers, first, last, self.size,
+                            self.validator)
+        position = first
+        try:
+            # Unbuffered, so a segment is on disk before it's recorded.
+            with open(self.partial_location, 'r+b', 0) as t_file:
+                t_file.seek(first)
+                for chunk in CHUNK_POOL.chunks(opener, last - first + 1):
+                    t_file.write(chunk)
+                    self.segments.add(position, position + len(chunk) - 1)
+                    position += len(chunk)
+                    with self.cond:
+                        self.written += len(chunk)
+                        self.cond.notify_all()
+        finally:
+            opener.close()
+        if position <= last:
+            raise IOError("Origin closed the connection early.")
+
+    def run(self):
+        """Takes the lock, downloads every segment, and finishes the fill."""
+        headers = {key: self.info[key] for key in PASSED_HEADERS
+                   if key in self.info}
+        if not self.start(200, headers):
+            return
+        pending = self.plan()
+        pending_lock = threading.Lock()
+        errors = []
+
+        def worker():
+            retries = 0
+            while not errors:
+                with pending_lock:
+                    if not pending:
+                        return
+                    first, last = pending.pop(0)
+                try:
+                    self.fetch_segment(first, last)
+                except OriginChanged as err:
+                    errors.append(err)
+                except Exception as err:
+                    # Try again for whatever didn't make it, from where
+                    # the connection was cut off.
+                    retries += 1
+                    if retries > MAX_RESUMES:
+                        errors.append(err)
+                        continue
+                    with pending_lock:
+                        pending[:0] = self.missing(first, last)
+
+        workers = [threading.Thread(target=worker)
+                   for _ in range(min(self.connections, len(pending)) or 1)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        # The lease is kept up from here, in the thread that took it.
+        for thread in workers:
+            while thread.is_alive():
+                thread.join(self.lease_ttl / 6.0)
+                try:
+                    self.heartbeat()
+                except RuntimeError as err:
+                    errors.append(err)
+
+        if self.segments.is_complete:
+            self.finish()
+        else:
+            self.abort()
+
+    def launch(self):
+        """Runs the fill in the background."""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,285 @@
+from __future__ import print_function
+import threading
+import os.path
+import fcntl
+import time
+import os
+
+# Supported values of the `cache_eviction` config option: evict the least
+# recently used file first, or the least frequently used one.
+LRU = "lru"
+LFU = "lfu"
+POLICIES = (LRU, LFU)
+
+# How often, in seconds, the cache directory is rescanned to pick up files
+# added or removed by other processes.
+RESCAN_INTERVAL = 60
+
+# Files in the cache directory that belong to fills in progress, and are
+# never evicted.
+PARTIAL_SUFFIXES = (".part", ".extents", ".tmp")
+
+# How long, in seconds, a file handed to the front-end server to send is kept
+# from eviction. Nothing holds a lock on it for the server, but the server
+# only has to open it in time: removing it after that doesn't stop it being
+# sent.
+OFFLOAD_GRACE = 60
+
+
+class CachedFile(object):
+    """What's known about one complete file in the cache directory."""
+    def __init__(self, path, size, last_access, hits=0):
+        self.path = path
+        self.size = size
+        self.last_access = last_access
+        self.hits = hits
+        self.offloaded = 0
+
+
+class CacheManager(object):
+    """
+    Keeps the cache directory within `max_bytes` (and, optionally, keeps at
+    least `min_free_bytes` free on its disk) by evicting the least valuable
+    cached files, by recency or by hit count. An evicted file's entries fall
+    back to their remote location.
+
+    Files are served under a shared lock on the open file, and a file is only
+    evicted if an exclusive lock can be had on it, so a file being served by
+    any process is never removed. A file handed to the front-end server to
+    send has no lock, so it's kept for OFFLOAD_GRACE seconds instead, though
+    only by the process that handed it over; another process's eviction can
+    still remove it before the server opens it. Files still being filled
+    aren't in place yet, so they're never candidates either.
+    """
+    def __init__(self, directory=None, max_bytes=0, min_free_bytes=0,
+                 policy=LRU):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.policy = policy
+        self.files = {}
+        self.used = 0
+        self.scanned = None
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.hits = 0
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        """True if there's any limit to enforce."""
+        return bool(self.directory and (self.max_bytes or self.min_free_bytes))
+
+    def is_cached(self, path):
+        """
+        True if `path` is a complete file in the cache directory, as `scan`
+        would find it. Anything else served, like a file in a bucket, is
+        never tracked, let alone evicted.
+        """
+        return bool(self.directory) and \
+            os.path.dirname(os.path.abspath(path)) == \
+            os.path.abspath(self.directory) and \
+            not path.endswith(PARTIAL_SUFFIXES)
+
+    def scan(self):
+        """
+        Rebuilds the list of cached files from the cache directory, keeping
+        what's known about the access to files already being tracked.
+        """
+        with self._lock:
+            files = {}
+            for name in os.listdir(self.directory):
+                if name.endswith(PARTIAL_SUFFIXES):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                known = self.files.get(path)
+                if known is not None:
+                    known.size = stat.st_size
+                    files[path] = known
+                else:
+                    files[path] = CachedFile(path, stat.st_size, stat.st_mtime)
+            self.files = files
+            self.used = sum(cached.size for cached in files.values())
+            self.scanned = time.time()
+
+    def refresh(self):
+        """Rescans the cache directory if it hasn't been for a while."""
+        if self.scanned is None or time.time() - self.scanned > RESCAN_INTERVAL:
+            self.scan()
+
+    def touch(self, path):
+        """Records an access to the cached file at `path`."""
+        with self._lock:
+            self.hits += 1
+            if not self.enabled or not self.is_cached(path):
+                return
+            cached = self.files.get(path)
+            if cached is None:
+                try:
+                    cached = CachedFile(path, os.path.getsize(path), 0)
+                except OSError:
+                    return
+                self.files[path] = cached
+                self.used += cached.size
+            cached.last_access = time.time()
+            cached.hits += 1
+
+    def offloaded(self, path):
+        """
+        Records an access to the cached file at `path` that's been handed to
+        the front-end server to send, keeping it for OFFLOAD_GRACE seconds.
+        """
+        self.touch(path)
+        with self._lock:
+            cached = self.files.get(path)
+            if cached is not None:
+                cached.offloaded = time.time()
+
+    def open(self, path):
+        """
+        Opens the cached file at `path` to serve it, holding a shared lock on
+        it for as long as it's open so it can't be evicted. Returns None if
+        the file is gone, or being evicted.
+        """
+        try:
+            t_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            fcntl.flock(t_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            t_file.close()
+            return None
+        self.touch(path)
+        return t_file
+
+    def added(self, path):
+        """Starts tracking a newly cached file, evicting others to fit it."""
+        if not self.enabled or not self.is_cached(path):
+            return
+        with self._lock:
+            self.refresh()
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                return
+            old = self.files.get(path)
+            self.used += size - (old.size if old else 0)
+            self.files[path] = CachedFile(path, size, time.time(),
+                                          old.hits if old else 0)
+            self.enforce(protect=path)
+
+    def forget(self, path):
+        """Stops tracking a cached file that's been removed."""
+        with self._lock:
+            cached = self.files.pop(path, None)
+            if cached is not None:
+                self.used -= cached.size
+
+    def make_room(self, incoming):
+        """Evicts files to make room for one of `incoming` bytes."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.refresh()
+            self.enforce(incoming)
+
+    def free_bytes(self):
+        """Space available on the cache directory's disk."""
+        stat = os.statvfs(self.directory)
+        return stat.f_bavail * stat.f_frsize
+
+    def over_limit(self, incoming=0):
+        """True if the cache, plus `incoming` bytes, breaks either limit."""
+        if self.max_bytes and self.used + incoming > self.max_bytes:
+            return True
+        if self.min_free_bytes and \
+                self.free_bytes() - incoming < self.min_free_bytes:
+            return True
+        return False
+
+    def value(self, cached):
+        """Sort key for eviction; the lowest value goes first."""
+        if self.policy == LFU:
+            return (cached.hits, cached.last_access)
+        return (cached.last_access, cached.hits)
+
+    def enforce(self, incoming=0, protect=None):
+        """
+        Evicts the least valuable files until the cache, plus `incoming`
+        bytes, is within its limits, or nothing more can be evicted.
+        """
+        with self._lock:
+            if not self.over_limit(incoming):
+                return
+            for cached in sorted(self.files.values(), key=self.value):
+                if cached.path == protect:
+                    continue
+                self.evict(cached)
+                if not self.over_limit(incoming):
+                    return
+
+    def evict(self, cached):
+        """
+        Removes a cached file, unless it's being served, and points its
+        entries back at their remote location. Returns True if it's gone.
+        """
+        import database
+        if not self.is_cached(cached.path):
+            return False
+        if time.time() - cached.offloaded < OFFLOAD_GRACE:
+            # The front-end server may not have opened it yet.
+            return False
+        try:
+            t_file = open(cached.path, 'rb')
+        except IOError:
+            t_file = None
+        if t_file is not None:
+            try:
+                fcntl.flock(t_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Someone's serving it.
+                t_file.close()
+                return False
+            try:
+                os.remove(cached.path)
+            finally:
+                t_file.close()
+            print("Evicted from cache:", cached.path)
+            self.evictions += 1
+            self.evicted_bytes += cached.size
+        self.forget(cached.path)
+        # A fill may have put the file back in the meantime.
+        if not os.path.exists(cached.path):
+            database.AlchemyDatabase().clear_location(cached.path)
+        return True
+
+    def stats(self):
+        """Returns the cache's size, limits, hit and eviction counters."""
+        with self._lock:
+            return {
+                'files': len(self.files),
+                'used_bytes': self.used,
+                'max_bytes': self.max_bytes,
+                'min_free_bytes': self.min_free_bytes,
+                'policy': self.policy,
+                'hits': self.hits,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+# The process-wide cache manager, set up by `configure`.
+CACHE = CacheManager()
+
+
+def configure(config):
+    """Sets up the process-wide cache manager from the config."""
+    CACHE.directory = os.path.abspath(config.cache)
+    CACHE.max_bytes = config.max_cache_bytes
+    CACHE.min_free_bytes = config.min_free_bytes
+    CACHE.policy = config.cache_eviction
+    CACHE.scanned = None
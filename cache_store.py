@@ -0,0 +1,117 @@
+from __future__ import print_function
+import posixpath
+import binascii
+import hashlib
+try:
+    import urlparse
+except ImportError:
+    # Python 3, which async_proxy runs on.
+    from urllib import parse as urlparse
+import os.path
+import base64
+
+# Default ports, dropped from URLs when normalizing them.
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+
+def normalize_url(url):
+    """
+    Puts a remote URL in a canonical form, so that different spellings of the
+    same URL share one cached object: the scheme and host are lower-cased,
+    default ports and fragments are dropped, and an empty path becomes `/`.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{0}'.format(parts.port)
+    if parts.username:
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+    return urlparse.urlunsplit(
+        (scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def object_key(url):
+    """The key of the cached object for the remote file at `url`."""
+    url = normalize_url(url)
+    if not isinstance(url, bytes):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()
+
+
+def object_location(url, cache_dir):
+    """
+    Where the cached object for `url` is kept: named by its key, keeping the
+    URL's extension so its type can still be guessed from the name.
+    """
+    path = urlparse.urlsplit(url).path
+    extension = posixpath.splitext(posixpath.basename(path))[1]
+    return os.path.join(os.path.abspath(cache_dir), object_key(url) + extension)
+
+
+def hex_digest(encoded):
+    """A base64-encoded digest, in hex."""
+    return str(binascii.hexlify(base64.b64decode(encoded)).decode('ascii'))
+
+
+def expected_digests(headers):
+    """
+    The digests an origin gives for the body of a response, as a dict of
+    hashlib algorithm name to hex digest, from `Digest` (RFC 3230) and
+    `Content-MD5` headers.
+    """
+    digests = {}
+    for key in headers:
+        name = key.lower()
+        if name == 'digest':
+            for value in headers[key].split(','):
+                algorithm, _, encoded = value.strip().partition('=')
+                algorithm = algorithm.lower().replace('-', '')
+                if algorithm in ('sha256', 'md5') and encoded:
+                    try:
+                        digests[algorithm] = hex_digest(encoded)
+                    except (TypeError, ValueError):
+                        pass
+        elif name == 'content-md5':
+            try:
+                digests['md5'] = hex_digest(headers[key])
+            except (TypeError, ValueError):
+                pass
+    return digests
+
+
+class ContentHasher(object):
+    """
+    Hashes a cached object's content, with SHA-256 for the record and with
+    whatever algorithms the origin gave digests for, to check them.
+    """
+    def __init__(self, expected=None):
+        self.expected = expected or {}
+        self.hashes = {'sha256': hashlib.sha256()}
+        for algorithm in self.expected:
+            if algorithm not in self.hashes:
+                self.hashes[algorithm] = hashlib.new(algorithm)
+
+    def update(self, chunk):
+        """Adds the next chunk of the content."""
+        for hasher in self.hashes.values():
+            hasher.update(chunk)
+
+    def update_from_file(self, path, chunks):
+        """Hashes the whole file at `path`, reading it with `chunks`."""
+        with open(path, 'rb') as t_file:
+            for chunk in chunks(t_file):
+                self.update(chunk)
+
+    @property
+    def content_hash(self):
+        """The SHA-256 of the content, in hex."""
+        return self.hashes['sha256'].hexdigest()
+
+    def verify(self):
+        """True unless the content doesn't match a digest from the origin."""
+        return all(self.hashes[algorithm].hexdigest() == digest
+                   for algorithm, digest in self.expected.items())
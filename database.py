@@ -1,9 +1,20 @@
 from __future__ import print_function
 from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+from collections import OrderedDict
+import threading
+try:
+    import urlparse
+except ImportError:
+    # Python 3, which async_proxy runs on.
+    from urllib import parse as urlparse
 import datetime
+import socket
 import sqlite3
 import os.path
+import cache_store
 import random
+import time
 import json
 
 # These are just some pet debug functions I love to have around. You'll
@@ -26,18 +37,82 @@ def jp(indata):
     """Prints json representation of object"""
     print(json_dump(indata))
 
-def random_string(s_len=10): # returns nice 6 character strings
+# Characters file_ids are made of, unless configured otherwise.
+ID_ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+class IdGenerator(object):
+    """
+    Makes random ids of `length` characters from `alphabet`, from os.urandom,
+    `batch` ids at a time.
+
+    Every character is equally likely (bytes that would favour some are
+    dropped), so there are N = len(alphabet) ** length possible ids; with the
+    defaults, N = 36 ** 10, about 3.7e15. Among n ids, the chance that any two
+    are the same is about n ** 2 / 2N, and the chance that a new one is the
+    same as one of the others is n / N:
+
+        links         any two the same    a new one taken
+        100,000       1.4e-6              2.7e-11
+        1,000,000     1.4e-4              2.7e-10
+        10,000,000    1.4e-2              2.7e-9
+
+    Every extra character divides these by 36. Inserts don't check for a
+    collision first; the primary key catches it, and the insert is retried
+    with a fresh id.
+    """
+    def __init__(self, length=10, alphabet=ID_ALPHABET, batch=256):
+        if not 2 <= len(alphabet) <= 256 or \
+                len(set(alphabet)) != len(alphabet) or \
+                any(ord(char) > 127 for char in alphabet):
+            raise ValueError("An id alphabet must be 2 to 256 distinct ASCII "
+                             "characters.")
+        if length < 1:
+            raise ValueError("Ids must be at least one character long.")
+        self.length = length
+        self.alphabet = str(alphabet)
+        self.batch = batch
+        # Maps each byte onto a character, and drops the bytes past the
+        # largest multiple of the alphabet's size, which would favour the
+        # first few characters.
+        size = len(alphabet)
+        limit = 256 - 256 % size
+        self._table = bytes(bytearray(
+            ord(self.alphabet[byte % size]) for byte in range(256)))
+        self._dropped = bytes(bytearray(range(limit, 256)))
+        self._keep = limit / 256.0
+        self._ids = []
+        self._lock = threading.Lock()
+
+    def generate(self, count):
+        """Returns a list of `count` new ids."""
+        needed = count * self.length
+        chars = b""
+        while len(chars) < needed:
+            wanted = int((needed - len(chars)) / self._keep) + 16
+            chars += os.urandom(wanted).translate(self._table, self._dropped)
+        if not isinstance(chars, str):
+            chars = chars.decode('ascii')
+        return [chars[start:start + self.length]
+                for start in range(0, needed, self.length)]
+
+    def next(self):
+        """Returns a new id."""
+        with self._lock:
+            if not self._ids:
+                self._ids = self.generate(self.batch)
+            return self._ids.pop()
+
+# Makes file_ids; set up by `init_database`.
+FILE_IDS = IdGenerator()
+
+# How many times an insert is tried with a fresh file_id before giving up.
+MAX_ID_ATTEMPTS = 5
+
+def random_string(s_len=10):
     """Returns a random alpha-numeric string of length `s_len` (default 10)"""
-    to_return = ""
-    i = 0
-    while i < s_len:
-        if random.randint(0, 1): # If we get a 1, we do letters
-            to_return += chr(random.randint(97, 122))
- 
-        else: # we get a 0, we do a number
-            to_return += str(random.randint(1, 9))
-        i += 1
-    return to_return
+    if s_len == FILE_IDS.length:
+        return FILE_IDS.next()
+    return IdGenerator(s_len).generate(1)[0]
 
 def epoch_to_datetime(epoch):
     """Converts an epoch timestamp to datetime."""
@@ -56,6 +131,25 @@ class ConfigReader(object):
         self.buckets = ""
         self.cache = ""
         self.view_directories = ""
+        self.entry_cache_size = 1024
+        self.entry_cache_max_age = 60
+        self.chunk_pool_buffers = 64
+        self.offload = "none"
+        self.offload_locations = {}
+        self.parallel_fill = {}
+        self.fill_lease_ttl = 30
+        self.max_cache_bytes = 0
+        self.min_free_bytes = 0
+        self.cache_eviction = "lru"
+        self.reap_interval = 300
+        self.reap_batch_size = 500
+        self.accounting_interval = 10
+        self.accounting_max_pending = 1000
+        self.index_refresh_interval = 60
+        self.file_id_length = 10
+        self.file_id_alphabet = ID_ALPHABET
+        self.async_io_threads = 16
+        self.proxy_buffer_bytes = 1048576
         self.read_config()
 
     def read_config(self):
@@ -78,10 +172,99 @@ class ConfigReader(object):
         self.password = c['password']
         self.buckets = c['buckets']
         self.cache = c['cache']
+        self.entry_cache_size = int(c.get('entry_cache_size', self.entry_cache_size))
+        self.entry_cache_max_age = float(c.get('entry_cache_max_age', self.entry_cache_max_age))
+        self.chunk_pool_buffers = int(c.get('chunk_pool_buffers', self.chunk_pool_buffers))
+
+        # How cached and local files are handed to a front-end server, if at
+        # all: "none", "x-accel-redirect" (nginx) or "x-sendfile" (Apache,
+        # lighttpd). nginx also needs `offload_locations`, mapping local
+        # directories onto its internal locations.
+        self.offload = c.get('offload', self.offload)
+        self.offload_locations = c.get('offload_locations', self.offload_locations)
+        if self.offload not in ("none", "x-accel-redirect", "x-sendfile"):
+            panic("Config option 'offload' must be one of 'none', 'x-accel-redirect' or 'x-sendfile'.")
+
+        # Origin hosts whose files are cached over several connections at
+        # once, each with `connections` and `min_segment_bytes`; "*" applies
+        # to every host not listed.
+        self.parallel_fill = c.get('parallel_fill', self.parallel_fill)
+
+        # How long, in seconds, a cache fill's lease lasts without being
+        # renewed before another worker may take the fill over.
+        self.fill_lease_ttl = float(c.get('fill_lease_ttl', self.fill_lease_ttl))
+
+        # Limits on the cache directory: its total size, and how much space
+        # to leave free on its disk (0 for no limit), and whether to evict
+        # the least recently ("lru") or least frequently ("lfu") used files
+        # first to stay within them.
+        self.max_cache_bytes = int(c.get('max_cache_bytes', self.max_cache_bytes))
+        self.min_free_bytes = int(c.get('min_free_bytes', self.min_free_bytes))
+        self.cache_eviction = c.get('cache_eviction', self.cache_eviction)
+        if self.cache_eviction not in ("lru", "lfu"):
+            panic("Config option 'cache_eviction' must be one of 'lru' or 'lfu'.")
+
+        # How often, in seconds, expired links and the cached files only they
+        # used are deleted (0 to never), and how many links to delete per
+        # transaction.
+        self.reap_interval = float(c.get('reap_interval', self.reap_interval))
+        self.reap_batch_size = int(c.get('reap_batch_size', self.reap_batch_size))
+        if self.reap_batch_size < 1:
+            panic("Config option 'reap_batch_size' must be at least 1.")
+
+        # Download counts, bytes served and last access times are collected
+        # in memory and written every `accounting_interval` seconds, or as
+        # soon as `accounting_max_pending` links have unwritten counts.
+        self.accounting_interval = float(c.get('accounting_interval', self.accounting_interval))
+        self.accounting_max_pending = int(c.get('accounting_max_pending', self.accounting_max_pending))
+        if self.accounting_interval <= 0:
+            panic("Config option 'accounting_interval' must be positive.")
+
+        # How often, in seconds, the index of the files in the buckets checks
+        # for changes (more often than that with pyinotify installed).
+        self.index_refresh_interval = float(c.get('index_refresh_interval', self.index_refresh_interval))
+
+        # How new file_ids are made: how many characters long, from which
+        # characters. See IdGenerator for how likely collisions are.
+        self.file_id_length = int(c.get('file_id_length', self.file_id_length))
+        self.file_id_alphabet = c.get('file_id_alphabet', self.file_id_alphabet)
+        try:
+            IdGenerator(self.file_id_length, self.file_id_alphabet)
+        except ValueError as err:
+            panic("Config options 'file_id_length' and 'file_id_alphabet': {0}".format(err))
+
+        # How many threads async_proxy keeps for reading and writing files
+        # and the database, which can't be done without blocking.
+        self.async_io_threads = int(c.get('async_io_threads', self.async_io_threads))
+        if self.async_io_threads < 1:
+            panic("Config option 'async_io_threads' must be at least 1.")
+
+        # How much of a proxied download is held for a client that's reading
+        # it slower than the origin sends it, before the download waits. It's
+        # taken, in whole chunks, from the chunk pool.
+        self.proxy_buffer_bytes = int(c.get('proxy_buffer_bytes', self.proxy_buffer_bytes))
+        if self.proxy_buffer_bytes < 1:
+            panic("Config option 'proxy_buffer_bytes' must be at least 1.")
+
+    def parallel_fill_for(self, url):
+        """
+        Returns the `(connections, min_segment_bytes)` to fill the cache from
+        `url` with, or None if its host doesn't use parallel fills.
+        """
+        host = urlparse.urlsplit(url).hostname
+        settings = self.parallel_fill.get(host, self.parallel_fill.get('*'))
+        if not settings or int(settings.get('connections', 1)) < 2:
+            return None
+        return (int(settings['connections']),
+                int(settings.get('min_segment_bytes', 8388608)))
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, Float, func, bindparam
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm.exc import StaleDataError, FlushError
+from sqlalchemy.exc import IntegrityError
+
+DEFAULT_DB_NAME = "links_database.sqlite3"
 
 BASE = declarative_base()
 
@@ -89,19 +272,23 @@ class FileEntry(BASE):
     """Class to hold entry for a file."""
     __tablename__ = "files"
     file_id = Column(String, primary_key=True)
-    expiration_date = Column(String)
-    local_location = Column(String)
-    remote_location = Column(String)
+    expiration_date = Column(Float, index=True)
+    local_location = Column(String, index=True)
+    remote_location = Column(String, index=True)
     download_count = Column(Integer)
-    lock = Column(Integer, default=0)
+    bytes_served = Column(Integer, default=0)
+    last_access = Column(Float)
 
     def __init__(self, file_id, expiration_date, local_location="", \
-        remote_location="", download_count=0):
+        remote_location="", download_count=0, bytes_served=0,
+        last_access=None):
         self.file_id = file_id
         self.expiration_date = expiration_date
         self.local_location = local_location
         self.remote_location = remote_location
         self.download_count = download_count
+        self.bytes_served = bytes_served
+        self.last_access = last_access
 
     def is_expired(self):
         """
@@ -140,41 +327,412 @@ class FileEntry(BASE):
             return True
         return False
 
-    def to_json(self):
-        """Return a json object of this instance."""
+    def to_json(self, file_exists=None):
+        """
+        Return a json object of this instance. `file_exists` may be given if
+        it's already known, to save checking for the file.
+        """
+        if file_exists is None:
+            file_exists = self.file_exists
         return {
             'file_id' : self.file_id,
             'file_location': self.file_location,
-            'file_exists' : self.file_exists,
+            'file_exists' : file_exists,
             'expiration_date' : self.expiration_date,
             'local_location' : self.local_location,
             'remote_location' : self.remote_location,
             'download_count' : self.download_count,
+            'bytes_served' : self.bytes_served,
+            'last_access' : self.last_access,
             'is_expired' : self.is_expired(),
-            'is_remote' : self.is_remote,
-            'is_locked' : self.lock
+            'is_remote' : self.is_remote
         }
 
+    def copy(self):
+        """Returns a detached copy of this entry, safe to share between sessions."""
+        entry = FileEntry(self.file_id, self.expiration_date,
+            local_location=self.local_location,
+            remote_location=self.remote_location,
+            download_count=self.download_count,
+            bytes_served=self.bytes_served,
+            last_access=self.last_access)
+        return entry
+
     def __repr__(self):
         return json_dump(self.to_json())
 
 
+class CacheObject(BASE):
+    """
+    A file in the cache, keyed by its normalized remote URL and shared by
+    every entry linking to that URL. `refcount` is the number of entries
+    using it; it's deleted along with the last of them.
+    """
+    __tablename__ = "cache_objects"
+    key = Column(String, primary_key=True)
+    url = Column(String)
+    location = Column(String, index=True)
+    size = Column(Integer)
+    content_hash = Column(String)
+    refcount = Column(Integer, default=0)
+
+    def __init__(self, key, url, location, size=None, content_hash=None):
+        self.key = key
+        self.url = url
+        self.location = location
+        self.size = size
+        self.content_hash = content_hash
+        self.refcount = 0
+
+
+class FillLease(BASE):
+    """
+    A lease on filling one cached object. Only the holder of a lease that
+    hasn't expired may fill the object; the holder renews it while the fill
+    is making progress, and anyone may take it over once it expires, so a
+    worker that dies mid-fill doesn't keep the object from being cached.
+    """
+    __tablename__ = "cache_leases"
+    key = Column(String, primary_key=True)
+    owner = Column(String)
+    acquired = Column(Float)
+    expires = Column(Float)
+
+    def __init__(self, key, owner, acquired, expires):
+        self.key = key
+        self.owner = owner
+        self.acquired = acquired
+        self.expires = expires
+
+
+def lease_owner():
+    """A name for a new lease holder, unique across hosts and processes."""
+    return "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(),
+                                random_string())
+
+
+class LeaseStats(object):
+    """Counts what happens to the fill leases taken in this process."""
+    EVENTS = ('acquired', 'contended', 'stolen', 'renewed', 'lost', 'released')
+
+    def __init__(self):
+        self.counts = dict.fromkeys(self.EVENTS, 0)
+        self._lock = threading.Lock()
+
+    def count(self, event):
+        """Records one `event`."""
+        with self._lock:
+            self.counts[event] += 1
+
+    def stats(self):
+        """Returns a snapshot of the counters."""
+        with self._lock:
+            return dict(self.counts)
+
+LEASE_STATS = LeaseStats()
+
+
+class EntryCache(object):
+    """
+    A bounded LRU cache of detached FileEntry objects, keyed by file_id.
+
+    An entry is evicted once it reaches its expiration date, or once it's been
+    cached for `max_age` seconds so that changes made by other processes are
+    eventually picked up. Writes through AlchemyDatabase invalidate the
+    affected entry immediately.
+    """
+    def __init__(self, max_size=1024, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        """Returns the cached entry for `file_id`, or None."""
+        now = datetime_to_epoch(datetime.datetime.now())
+        with self._lock:
+            cached = self._entries.pop(file_id, None)
+            if cached is None or cached[1] <= now:
+                self.misses += 1
+                return None
+            self._entries[file_id] = cached
+            self.hits += 1
+            return cached[0]
+
+    def put(self, entry, generation=None):
+        """
+        Caches a detached `entry`, unless it's already expired. If the
+        `generation` the entry was read at is given and the cache has been
+        invalidated since, the entry may be stale and isn't cached.
+        """
+        if self.max_size <= 0:
+            return
+        now = datetime_to_epoch(datetime.datetime.now())
+        evict_at = float(entry.expiration_date)
+        if self.max_age is not None:
+            evict_at = min(evict_at, now + self.max_age)
+        if evict_at <= now:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(entry.file_id, None)
+            self._entries[entry.file_id] = (entry, evict_at)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, file_id):
+        """Drops `file_id` from the cache, if present."""
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(file_id, None)
+
+    def clear(self):
+        """Drops every cached entry."""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters along with the current size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'max_size': self.max_size
+            }
+
+
+def _migrate_numeric_expiry(cursor):
+    """
+    Version 1: stores expiration dates as REAL epoch timestamps rather than
+    strings, and indexes the columns that entries and cached objects are
+    looked up by.
+    """
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(files)")]
+    if 'file_location' in columns:
+        # Written by SqliteDatabase, with one file_location for both kinds.
+        select = """SELECT file_id, CAST(expiration_date AS REAL),
+                    CASE WHEN file_location LIKE '%://%' THEN ''
+                         ELSE file_location END,
+                    CASE WHEN file_location LIKE '%://%' THEN file_location
+                         ELSE '' END,
+                    download_count
+                    FROM files"""
+    else:
+        select = """SELECT file_id, CAST(expiration_date AS REAL),
+                    local_location, remote_location, download_count
+                    FROM files"""
+    # SQLite can't change a column's type in place, so the table is rebuilt.
+    cursor.execute("""CREATE TABLE files_new (
+        file_id VARCHAR NOT NULL,
+        expiration_date FLOAT,
+        local_location VARCHAR,
+        remote_location VARCHAR,
+        download_count INTEGER,
+        PRIMARY KEY (file_id)
+    )""")
+    cursor.execute("INSERT INTO files_new " + select)
+    cursor.execute("DROP TABLE files")
+    cursor.execute("ALTER TABLE files_new RENAME TO files")
+    for column in ('expiration_date', 'local_location', 'remote_location'):
+        cursor.execute("CREATE INDEX ix_files_{0} ON files ({0})".format(column))
+    tables = [row[0] for row in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")]
+    if 'cache_objects' in tables:
+        cursor.execute("""CREATE INDEX IF NOT EXISTS ix_cache_objects_location
+                          ON cache_objects (location)""")
+
+def _migrate_access_stats(cursor):
+    """Version 2: records the bytes served for, and last access to, entries."""
+    cursor.execute("ALTER TABLE files ADD COLUMN bytes_served INTEGER DEFAULT 0")
+    cursor.execute("ALTER TABLE files ADD COLUMN last_access FLOAT")
+
+# Changes to the schema of existing databases, in order. A database's version
+# is the number of them it's had, and is kept in SQLite's user_version.
+MIGRATIONS = [_migrate_numeric_expiry, _migrate_access_stats]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def upgrade_schema(engine):
+    """
+    Brings the schema of the database behind `engine` up to date, applying
+    the migrations it hasn't had in a single transaction, so an upgrade that
+    fails leaves it as it was. Tables that don't exist yet are created as
+    they are now.
+    """
+    raw = engine.raw_connection()
+    # Left to itself, sqlite3 commits before every schema change; the
+    # transaction is managed here instead.
+    isolation_level = raw.connection.isolation_level
+    raw.connection.isolation_level = None
+    try:
+        cursor = raw.cursor()
+        # Taking the write lock up front keeps two processes from both
+        # upgrading the same database.
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            recorded = cursor.execute("PRAGMA user_version").fetchone()[0]
+            tables = [row[0] for row in cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'")]
+            version = recorded
+            if 'files' not in tables:
+                # A new database, created as it is now.
+                version = SCHEMA_VERSION
+            for number in range(version, SCHEMA_VERSION):
+                print("Upgrading database schema to version", number + 1)
+                MIGRATIONS[number](cursor)
+            if recorded < SCHEMA_VERSION:
+                cursor.execute(
+                    "PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        raw.connection.isolation_level = isolation_level
+        raw.close()
+    BASE.metadata.create_all(engine, checkfirst=True)
+
+
+class ExistsCache(object):
+    """
+    Remembers whether files exist for up to `max_age` seconds, so listing
+    many entries doesn't stat every one of their files on every request.
+    Changes made through AlchemyDatabase invalidate the affected paths.
+    """
+    def __init__(self, max_size=100000, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def exists(self, path):
+        """True if there's a file at `path`, as of at most `max_age` ago."""
+        now = time.time()
+        with self._lock:
+            cached = self._paths.get(path)
+            if cached is not None and cached[1] > now:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        exists = os.path.isfile(path)
+        with self._lock:
+            if len(self._paths) >= self.max_size:
+                self._paths.clear()
+            self._paths[path] = (exists, now + self.max_age)
+        return exists
+
+    def invalidate(self, path):
+        """Forgets whether `path` exists."""
+        with self._lock:
+            self._paths.pop(path, None)
+
+    def stats(self):
+        """Returns the hit and miss counters along with the current size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._paths)
+            }
+
+# Whether entries' files exist, as shown in listings.
+FILE_EXISTS = ExistsCache()
+
+
+# One engine and one thread-local session registry per database file, shared
+# by the whole process. Building an engine and checking the schema is far more
+# expensive than the queries we run, so it's only done once. Each database
+# also gets one entry cache, shared by every thread.
+_SESSION_REGISTRIES = {}
+_ENTRY_CACHES = {}
+_REGISTRY_LOCK = threading.Lock()
+
+def get_session_registry(db_name=DEFAULT_DB_NAME):
+    """
+    Returns the process-wide scoped session registry for `db_name`, creating
+    the engine and the schema the first time that database is asked for.
+    """
+    registry = _SESSION_REGISTRIES.get(db_name)
+    if registry is not None:
+        return registry
+    with _REGISTRY_LOCK:
+        if db_name not in _SESSION_REGISTRIES:
+            engine = create_engine(
+                "sqlite:///"+db_name,
+                poolclass=QueuePool,
+                connect_args={'check_same_thread': False}
+            )
+            upgrade_schema(engine)
+            _SESSION_REGISTRIES[db_name] = scoped_session(
+                sessionmaker(bind=engine))
+        return _SESSION_REGISTRIES[db_name]
+
+def get_entry_cache(db_name=DEFAULT_DB_NAME):
+    """Returns the process-wide EntryCache for `db_name`."""
+    with _REGISTRY_LOCK:
+        if db_name not in _ENTRY_CACHES:
+            _ENTRY_CACHES[db_name] = EntryCache()
+        return _ENTRY_CACHES[db_name]
+
+def init_database(db_name=DEFAULT_DB_NAME, entry_cache_size=1024,
+                  entry_cache_max_age=60, file_id_length=10,
+                  file_id_alphabet=ID_ALPHABET):
+    """
+    Creates the engine and schema for `db_name`, sizes its entry cache and
+    sets up how new file_ids are made. Call once at startup.
+    """
+    global FILE_IDS
+    get_session_registry(db_name)
+    cache = get_entry_cache(db_name)
+    cache.max_size = entry_cache_size
+    cache.max_age = entry_cache_max_age
+    if (file_id_length, file_id_alphabet) != \
+            (FILE_IDS.length, FILE_IDS.alphabet):
+        FILE_IDS = IdGenerator(file_id_length, file_id_alphabet)
+
+def remove_session(db_name=DEFAULT_DB_NAME):
+    """
+    Closes and discards the session belonging to the current thread. Should be
+    called once a request (or a worker thread) is done with the database.
+    """
+    registry = _SESSION_REGISTRIES.get(db_name)
+    if registry is not None:
+        registry.remove()
+
 
 class AlchemyDatabase(object):
     """Database for holding file info. Uses SQLAlchemy as backend."""
-    def __init__(self, db_name="links_database.sqlite3"):
+    def __init__(self, db_name=DEFAULT_DB_NAME):
         self.db_name = db_name
-        self.db = create_engine("sqlite:///"+db_name)
-        self.session_class = sessionmaker()
-        self.session_class.configure(bind=self.db)
-        self.session = self.session_class()
-        FileEntry.metadata.create_all(self.db, checkfirst=True)
+        self.session = get_session_registry(db_name)
+        self.entry_cache = get_entry_cache(db_name)
 
-    def new_entry(self, local_location, expire_delta=1, remote_location=""):
-        """Create a new file entry object and store it in the database."""
+    def lookup(self, file_id):
+        """
+        Returns a detached FileEntry for `file_id`, or None, going to the
+        database only if the entry cache doesn't have it.
+        """
+        entry = self.entry_cache.get(file_id)
+        if entry is None:
+            generation = self.entry_cache.generation
+            row = self.session.query(FileEntry).filter_by(file_id=file_id).first()
+            if row:
+                entry = row.copy()
+                self.entry_cache.put(entry, generation)
+        return entry
 
-        file_id = random_string()
-        now = datetime.datetime.now()
+    def build_entry(self, local_location, expire_delta=1, remote_location="",
+                    now=None):
+        """Makes, but doesn't store, a FileEntry with a new file_id."""
+        if now is None:
+            now = datetime.datetime.now()
         expiration_date = now + datetime.timedelta(days=expire_delta)
         expire_date = datetime_to_epoch(expiration_date)
 
@@ -183,30 +741,300 @@ class AlchemyDatabase(object):
             remote_location = local_location
             local_location = ""
 
-        entry = FileEntry(file_id, remote_location=remote_location,\
-            local_location=local_location, expiration_date=str(expire_date))
-        self.session.add(entry)
-        self.session.commit()
+        return FileEntry(FILE_IDS.next(), remote_location=remote_location,\
+            local_location=local_location, expiration_date=expire_date)
+
+    def link_cached(self, entries):
+        """
+        Points the remote `entries` at the cached objects for their URLs,
+        where there already is one. Doesn't commit.
+        """
+        by_key = {}
+        for entry in entries:
+            if entry.remote_location and not entry.local_location:
+                by_key.setdefault(cache_store.object_key(entry.remote_location),
+                                  []).append(entry)
+        keys = list(by_key)
+        # SQLite allows only so many parameters in one query.
+        for start in range(0, len(keys), 500):
+            for obj in self.session.query(CacheObject).filter(
+                    CacheObject.key.in_(keys[start:start + 500])):
+                if not os.path.isfile(obj.location):
+                    continue
+                for entry in by_key[obj.key]:
+                    entry.local_location = obj.location
+                    obj.refcount += 1
+
+    def new_entry(self, local_location, expire_delta=1, remote_location=""):
+        """
+        Create a new file entry object and store it in the database. Returns
+        its file_id.
+        """
+        entry = self.build_entry(local_location, expire_delta, remote_location)
+        return self.insert_entries([entry])[0]
+
+    def new_entries(self, items):
+        """
+        Creates an entry for each `(location, expire_delta)` in `items`, all
+        in one transaction. Returns a list with, for each item in order,
+        either its new file_id or the ValueError that kept it from being
+        created; bad items don't stop the others.
+        """
+        now = datetime.datetime.now()
+        results, entries = [], []
+        for location, expire_delta in items:
+            if not isinstance(location, basestring) or not location.strip():
+                results.append(ValueError("A location must be given."))
+                continue
+            try:
+                entry = self.build_entry(location, expire_delta, now=now)
+            except (TypeError, ValueError, OverflowError):
+                results.append(ValueError(
+                    "The expiration delta must be a number of days."))
+                continue
+            results.append(entry.file_id)
+            entries.append(entry)
+        # Collisions may have changed some ids.
+        file_ids = iter(self.insert_entries(entries))
+        return [result if isinstance(result, Exception) else next(file_ids)
+                for result in results]
+
+    def insert_entries(self, entries):
+        """
+        Stores new `entries` in one transaction, linking remote ones to
+        whatever's already cached for them. If any of their file_ids is
+        taken, they all get fresh ones and it's tried again, up to
+        MAX_ID_ATTEMPTS times. Returns their file_ids.
+        """
+        local_locations = [entry.local_location for entry in entries]
+        for attempt in range(MAX_ID_ATTEMPTS):
+            # Read now, since committing expires them.
+            file_ids = [entry.file_id for entry in entries]
+            self.link_cached(entries)
+            self.session.add_all(entries)
+            try:
+                self.session.commit()
+                break
+            except (IntegrityError, FlushError):
+                self.session.rollback()
+                if attempt == MAX_ID_ATTEMPTS - 1:
+                    raise
+                print("file_id collision, trying again with new ids.")
+                # Linked again on the next try, to the objects as they
+                # were before the rollback.
+                for entry, local_location in zip(entries, local_locations):
+                    entry.file_id = FILE_IDS.next()
+                    entry.local_location = local_location
+        for file_id in file_ids:
+            self.entry_cache.invalidate(file_id)
+        return file_ids
 
     def remove_entry(self, file_id):
-        """Deletes the FileEntry with the given file_id from the database."""
+        """
+        Deletes the FileEntry with the given file_id from the database.
+        Returns the location of its cached copy if it was the last entry
+        using it, so the caller can delete the file, or None.
+        """
+        orphan = None
         entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
         if entry:
+            if entry.remote_location and entry.local_location:
+                orphan = self.release_object(entry.local_location, file_id)
             self.session.delete(entry)
             self.session.commit()
+        self.entry_cache.invalidate(file_id)
+        return orphan
+
+    def record_access(self, counts):
+        """
+        Adds to the access stats of many entries in one transaction. `counts`
+        maps file_ids to `(downloads, bytes_served, last_access)`; entries
+        that no longer exist are skipped.
+        """
+        if not counts:
+            return
+        table = FileEntry.__table__
+        update = table.update().where(
+            table.c.file_id == bindparam('b_file_id')
+        ).values(
+            download_count=func.coalesce(table.c.download_count, 0) +
+            bindparam('b_downloads'),
+            bytes_served=func.coalesce(table.c.bytes_served, 0) +
+            bindparam('b_bytes'),
+            last_access=func.max(func.coalesce(table.c.last_access, 0),
+                                 bindparam('b_last_access'))
+        )
+        self.session.execute(update, [
+            {'b_file_id': file_id, 'b_downloads': downloads,
+             'b_bytes': served, 'b_last_access': last_access}
+            for file_id, (downloads, served, last_access) in counts.items()])
+        self.session.commit()
+        # Cached entries are left to pick the new counts up when they age
+        # out; invalidating them would cost every popular link a query.
+
+    def reap_expired(self, now, limit=500):
+        """
+        Deletes up to `limit` of the entries that expired before the epoch
+        timestamp `now`, oldest first, in one transaction. Returns the
+        file_ids deleted, and the locations of cached files no longer used by
+        any entry, which the caller should delete.
+        """
+        expired = self.session.query(FileEntry).filter(
+            FileEntry.expiration_date < now
+        ).order_by(FileEntry.expiration_date).limit(limit).all()
+        orphans = set()
+        for entry in expired:
+            if entry.remote_location and entry.local_location:
+                orphan = self.release_object(entry.local_location,
+                                             entry.file_id)
+                if orphan:
+                    orphans.add(orphan)
+            self.session.delete(entry)
+        try:
+            self.session.commit()
+        except StaleDataError:
+            # Another process reaped some of them first; they'll be picked up
+            # on the next pass, if there's anything left.
+            self.session.rollback()
+            return [], []
+        file_ids = [entry.file_id for entry in expired]
+        for file_id in file_ids:
+            self.entry_cache.invalidate(file_id)
+        return file_ids, sorted(orphans)
+
+    def release_object(self, location, file_id):
+        """
+        Drops one reference to the cached object at `location`, on behalf of
+        the entry `file_id`, deleting the object once nothing uses it. Returns
+        `location` if the file is no longer needed. Doesn't commit.
+        """
+        obj = self.session.query(CacheObject).filter_by(location=location).first()
+        if obj is None:
+            # Cached before objects were shared; it's the file's last user
+            # if no other entry points at it.
+            others = self.session.query(FileEntry).filter(
+                FileEntry.local_location == location,
+                FileEntry.file_id != file_id).count()
+            return location if others == 0 else None
+        obj.refcount -= 1
+        if obj.refcount > 0:
+            return None
+        self.session.delete(obj)
+        return location
+
+    def get_object(self, key):
+        """Returns the CacheObject with the given key, or None."""
+        return self.session.query(CacheObject).get(key)
+
+    def store_object(self, key, url, location, size=None, content_hash=None):
+        """
+        Records a newly filled cached object and links every uncached entry
+        for `url` to it. Returns the file_ids linked.
+        """
+        obj = self.session.query(CacheObject).get(key)
+        if obj is None:
+            obj = CacheObject(key, url, location, size, content_hash)
+            self.session.add(obj)
+        else:
+            obj.location, obj.size, obj.content_hash = \
+                location, size, content_hash
+        linked = self.session.query(FileEntry).filter(
+            FileEntry.remote_location == url,
+            FileEntry.local_location == "").all()
+        for entry in linked:
+            entry.local_location = location
+        obj.refcount = self.session.query(FileEntry).filter_by(
+            local_location=location).count()
+        self.session.commit()
+        FILE_EXISTS.invalidate(location)
+        for entry in linked:
+            self.entry_cache.invalidate(entry.file_id)
+        return [entry.file_id for entry in linked]
+
+    def link_object(self, file_id, key):
+        """
+        Points the entry `file_id` at the cached object `key`, if the object's
+        file is there. Returns the object's location, or None.
+        """
+        obj = self.session.query(CacheObject).get(key)
+        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
+        location = linked = None
+        if obj is not None and entry is not None and \
+                os.path.isfile(obj.location):
+            location = obj.location
+            if entry.local_location != location:
+                entry.local_location = location
+                obj.refcount += 1
+                linked = True
+        # Ends the transaction either way: the caller may go on to wait for a
+        # fill, and mustn't hold a pooled connection while it does.
+        self.session.commit()
+        if linked:
+            self.entry_cache.invalidate(file_id)
+        return location
 
     def get_entry(self, file_id):
         """Returns dict representing given FileEntry."""
-        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
+        entry = self.lookup(file_id)
         if entry:
             return entry.to_json()
 
+    def list_entries(self, after=None, limit=100, expired=None, cached=None,
+                     remote=None, now=None):
+        """
+        Returns a page of at most `limit` entries as dicts, in file_id order,
+        starting after the file_id `after`, and the cursor for the next page
+        (None if this is the last). Each filter, if not None, keeps only the
+        entries that are (True) or aren't (False): `expired` as of the epoch
+        timestamp `now`; `cached`, with a local copy; `remote`, linking to a
+        remote URL. Whether files exist comes from FILE_EXISTS.
+        """
+        if now is None:
+            now = datetime_to_epoch(datetime.datetime.now())
+        query = self.session.query(FileEntry)
+        if after is not None:
+            query = query.filter(FileEntry.file_id > after)
+        if expired is not None:
+            query = query.filter(FileEntry.expiration_date < now if expired
+                                 else FileEntry.expiration_date >= now)
+        if cached is not None:
+            query = query.filter(FileEntry.local_location != "" if cached
+                                 else func.coalesce(
+                                     FileEntry.local_location, "") == "")
+        if remote is not None:
+            query = query.filter(FileEntry.remote_location != "" if remote
+                                 else func.coalesce(
+                                     FileEntry.remote_location, "") == "")
+        entries = query.order_by(FileEntry.file_id).limit(limit + 1).all()
+        cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            cursor = entries[-1].file_id
+        leased = set(key for key, in self.session.query(
+            FillLease.key).filter(FillLease.expires >= time.time()))
+        page = []
+        for entry in entries:
+            if entry.local_location:
+                exists = FILE_EXISTS.exists(entry.local_location)
+            else:
+                exists = bool(entry.remote_location)
+            row = entry.to_json(file_exists=exists)
+            row['is_locked'] = bool(entry.remote_location) and \
+                cache_store.object_key(entry.remote_location) in leased
+            page.append(row)
+        return page, cursor
+
     def to_dict(self):
         """Returns dict representing all rows in Database."""
         to_return = {}
         entries = self.session.query(FileEntry).all()
+        leased = set(key for key, in self.session.query(
+            FillLease.key).filter(FillLease.expires >= time.time()))
         for entry in entries:
             to_return[entry.file_id] = entry.to_json()
+            to_return[entry.file_id]['is_locked'] = bool(
+                entry.remote_location) and \
+                cache_store.object_key(entry.remote_location) in leased
         return to_return
 
     def update_location(self, file_id, local_location):
@@ -215,40 +1043,94 @@ class AlchemyDatabase(object):
         if entry:
             entry.local_location = local_location
             self.session.commit()
+        self.entry_cache.invalidate(file_id)
+
+    def clear_location(self, local_location):
+        """
+        Points every cached entry whose local copy is at `local_location` back
+        at its remote location, once that copy is gone.
+        """
+        entries = self.session.query(FileEntry).filter(
+            FileEntry.local_location == local_location,
+            FileEntry.remote_location != "").all()
+        for entry in entries:
+            entry.local_location = ""
+        self.session.query(CacheObject).filter_by(
+            location=local_location).delete(synchronize_session=False)
+        self.session.commit()
+        FILE_EXISTS.invalidate(local_location)
+        for entry in entries:
+            self.entry_cache.invalidate(entry.file_id)
 
     def is_locked(self, file_id):
-        """Returns true if the given file_id has a lock of '1'."""
-        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
-        if not entry:
+        """
+        Returns true if someone holds an unexpired fill lease on the cached
+        object for file_id.
+        """
+        entry = self.lookup(file_id)
+        if entry is None:
             raise KeyError("No entry with that file_id exists.")
-        if entry.lock == 0:
+        if not entry.remote_location:
             return False
-        elif entry.lock == 1:
-            return True
+        return self.session.query(FillLease).filter(
+            FillLease.key == cache_store.object_key(entry.remote_location),
+            FillLease.expires >= time.time()).count() > 0
 
-    def lock_entry(self, file_id):
-        """Locks an entry with given file_id."""
-        print("Locking entry:", file_id)
-        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
-        if not entry:
-            raise KeyError("No entry with that file_id exists.")
-        if entry.lock == 0:
-            entry.lock = 1
+    def acquire_lease(self, key, owner, ttl=30):
+        """
+        Takes the fill lease on the cached object `key` for `owner`, for `ttl`
+        seconds, taking it over if its last holder let it expire. Raises
+        RuntimeError if someone else holds it.
+        """
+        now = time.time()
+        self.session.add(FillLease(key, owner, now, now + ttl))
+        try:
             self.session.commit()
-        elif entry.lock == 1:
-            raise RuntimeError("Entry with given file_id is already locked.")
-
-    def unlock_entry(self, file_id):
-        """Unlocks an entry with the given file_id."""
-        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
-        if not entry:
-            raise KeyError("No entry with that file_id exists.")
-        entry.lock = 0
+            LEASE_STATS.count('acquired')
+            return
+        except IntegrityError:
+            self.session.rollback()
+
+        # Someone has held it; it's ours only if they've let it expire.
+        taken = self.session.query(FillLease).filter(
+            FillLease.key == key,
+            FillLease.expires < now
+        ).update({'owner': owner, 'acquired': now, 'expires': now + ttl},
+                 synchronize_session=False)
+        self.session.commit()
+        if not taken:
+            LEASE_STATS.count('contended')
+            raise RuntimeError("Cached object is already being filled.")
+        print("Took over stale fill lease:", key)
+        LEASE_STATS.count('acquired')
+        LEASE_STATS.count('stolen')
+
+    def renew_lease(self, key, owner, ttl=30):
+        """
+        Extends `owner`'s lease on `key` to `ttl` seconds from now. Raises
+        RuntimeError if it's no longer theirs.
+        """
+        renewed = self.session.query(FillLease).filter_by(
+            key=key, owner=owner
+        ).update({'expires': time.time() + ttl}, synchronize_session=False)
+        self.session.commit()
+        if not renewed:
+            LEASE_STATS.count('lost')
+            raise RuntimeError("Lost the fill lease on the cached object.")
+        LEASE_STATS.count('renewed')
+
+    def release_lease(self, key, owner):
+        """Gives up `owner`'s lease on `key`, if they still hold it."""
+        released = self.session.query(FillLease).filter_by(
+            key=key, owner=owner
+        ).delete(synchronize_session=False)
         self.session.commit()
+        if released:
+            LEASE_STATS.count('released')
 
     def is_cached(self, file_id):
         """Returns true if the entry has a local location."""
-        entry = self.session.query(FileEntry).filter_by(file_id=file_id).first()
+        entry = self.lookup(file_id)
         if not entry:
             raise KeyError("No entry with that file_id exists.")
         if entry.local_location:
@@ -261,7 +1143,7 @@ class AlchemyDatabase(object):
 
 class SqliteDatabase(object):
     """Database for holding the file information. Uses Sqlite3 as backend."""
-    def __init__(self, db_name="links_database.sqlite3"):
+    def __init__(self, db_name=DEFAULT_DB_NAME):
         self.connection = sqlite3.connect(db_name)
         self.cursor = self.connection.cursor()
         
@@ -275,6 +1157,12 @@ class SqliteDatabase(object):
             "timestamp" TEXT DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
             UNIQUE(file_id)
         )""")
+        # A database AlchemyDatabase has upgraded has no file_location.
+        columns = [row[1] for row in
+                   self.cursor.execute("PRAGMA table_info(files)")]
+        if 'file_location' in columns:
+            self.cursor.execute("""CREATE INDEX IF NOT EXISTS
+                ix_files_file_location ON files (file_location)""")
 
     def convert_results(self, results, fields):
         """Maps results of query into list of dict-as-objects."""
@@ -351,16 +1239,22 @@ class SqliteDatabase(object):
     def new_entry(self, location, expiration_delta=1):
         """Creates entry for the new file in the database, returning its id."""
 
-        file_id = random_string()
-
         now = datetime.datetime.now()
         expiration_date = now + datetime.timedelta(days=expiration_delta)
         expiration_date = datetime_to_epoch(expiration_date)
 
-        self.cursor.execute("""
-            INSERT INTO files 
-                (file_id, file_location, expiration_date, download_count)
-            VALUES (?,?,?,?)""", (file_id, location, expiration_date, 0))
+        # UNIQUE(file_id) catches the rare id that's already taken.
+        for attempt in range(MAX_ID_ATTEMPTS):
+            file_id = FILE_IDS.next()
+            try:
+                self.cursor.execute("""
+                    INSERT INTO files 
+                        (file_id, file_location, expiration_date, download_count)
+                    VALUES (?,?,?,?)""", (file_id, location, expiration_date, 0))
+                break
+            except sqlite3.IntegrityError:
+                if attempt == MAX_ID_ATTEMPTS - 1:
+                    raise
         self.connection.commit()
         return file_id
 
@@ -404,6 +1298,118 @@ def main():
     #         d.remove_entry(x)
     jp(d.to_dict())
 
+def benchmark(iterations=500, db_name="benchmark_database.sqlite3"):
+    """
+    Compares the cost of a `get_entry` call when each request builds its own
+    engine (the old behaviour) against using the shared session registry.
+    """
+    import timeit
+
+    def per_request_engine():
+        engine = create_engine("sqlite:///"+db_name)
+        session = sessionmaker(bind=engine)()
+        FileEntry.metadata.create_all(engine, checkfirst=True)
+        session.query(FileEntry).filter_by(file_id="x").first()
+        session.close()
+        engine.dispose()
+
+    def shared_registry():
+        AlchemyDatabase(db_name).get_entry("x")
+        remove_session(db_name)
+
+    init_database(db_name)
+    for name, func in [("per-request engine", per_request_engine),
+                       ("shared registry", shared_registry)]:
+        total = timeit.timeit(func, number=iterations)
+        print("{:<20} {:8.3f} ms/request".format(
+            name, total / iterations * 1000))
+    os.remove(db_name)
+
+def benchmark_schema(rows=1000000, lookups=200,
+                     db_name="benchmark_schema.sqlite3"):
+    """
+    Times the expiry and location lookups on a `files` table of `rows`
+    entries laid out as before the first migration (string expiration dates,
+    no indexes), then upgrades it in place and times them again.
+    """
+    import timeit
+    if os.path.exists(db_name):
+        os.remove(db_name)
+    connection = sqlite3.connect(db_name)
+    connection.execute("""CREATE TABLE files (
+        file_id VARCHAR NOT NULL,
+        expiration_date VARCHAR,
+        local_location VARCHAR,
+        remote_location VARCHAR,
+        download_count INTEGER,
+        PRIMARY KEY (file_id)
+    )""")
+    now = time.time()
+    def row(number):
+        # A day's worth of expired links, the rest due over the next month.
+        expires = now + random.uniform(-86400, 30 * 86400)
+        remote = "http://example.com/{0}.bin".format(number)
+        return ("f{0}".format(number), str(expires),
+                "/cache/{0}.bin".format(number) if number % 2 else "",
+                remote, 0)
+    connection.executemany("INSERT INTO files VALUES (?,?,?,?,?)",
+                           (row(number) for number in xrange(rows)))
+    connection.commit()
+
+    def expired_before():
+        # All there was to go on: every row, its date parsed in Python.
+        return [file_id for file_id, expires in connection.execute(
+            "SELECT file_id, expiration_date FROM files")
+            if float(expires) < now][:500]
+    def expired_after():
+        return connection.execute(
+            """SELECT file_id FROM files WHERE expiration_date < ?
+               ORDER BY expiration_date LIMIT 500""", (now,)).fetchall()
+    def by_location():
+        number = random.randrange(rows)
+        connection.execute("SELECT file_id FROM files WHERE local_location=?",
+                           ("/cache/{0}.bin".format(number),)).fetchall()
+        connection.execute("SELECT file_id FROM files WHERE remote_location=?",
+                           ("http://example.com/{0}.bin".format(number),)
+                           ).fetchall()
+
+    def report(name, func, number):
+        total = timeit.timeit(func, number=number)
+        print("{:<32} {:10.3f} ms".format(name, total / number * 1000))
+
+    print("{0} rows".format(rows))
+    report("expired links, before", expired_before, 3)
+    report("location lookups, before", by_location, 3)
+    start = time.time()
+    upgrade_schema(create_engine("sqlite:///"+db_name))
+    print("{:<32} {:10.3f} s".format("upgrade", time.time() - start))
+    report("expired links, after", expired_after, lookups)
+    report("location lookups, after", by_location, lookups)
+    connection.close()
+    os.remove(db_name)
+
+def benchmark_ids(count=100000):
+    """
+    Compares making `count` file_ids a character at a time with `random`
+    (the old way) against IdGenerator.
+    """
+    import timeit
+
+    def one_at_a_time():
+        to_return = ""
+        for _ in range(10):
+            if random.randint(0, 1):
+                to_return += chr(random.randint(97, 122))
+            else:
+                to_return += str(random.randint(1, 9))
+        return to_return
+
+    generator = IdGenerator()
+    for name, func in [("random, per character", one_at_a_time),
+                       ("IdGenerator.next", generator.next)]:
+        total = timeit.timeit(func, number=count)
+        print("{:<24} {:8.3f} us/id".format(name, total / count * 1e6))
+
 
 if __name__ == '__main__':
     main()
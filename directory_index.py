@@ -0,0 +1,343 @@
+from __future__ import print_function
+import threading
+import os.path
+import time
+import os
+
+# scandir is in os from Python 3.5, and a package before that; without it,
+# telling files from directories takes a stat per entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# With pyinotify, changes are picked up as they happen instead of on the next
+# poll.
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# How far back, in seconds, a directory's mtime has to be for it to be
+# trusted: a directory changed within the same tick as it was read could
+# change again without its mtime moving.
+MTIME_SLACK = 1.0
+
+
+def list_directory(path):
+    """
+    Returns the names of the files, and of the directories, in `path`. Like
+    `os.walk`, symlinks to directories are neither.
+    """
+    files, dirs = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry.name)
+            elif not entry.is_dir():
+                files.append(entry.name)
+        return files, dirs
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        if os.path.isdir(full):
+            if not os.path.islink(full):
+                dirs.append(name)
+        else:
+            files.append(name)
+    return files, dirs
+
+
+def within_roots(path, roots):
+    """
+    Returns `path` made absolute if, with symlinks resolved, it's one of the
+    directories in `roots` or somewhere under one; None otherwise.
+    """
+    path = os.path.abspath(path)
+    real = os.path.realpath(path)
+    for root in roots:
+        root = os.path.realpath(root)
+        if real == root or real.startswith(root.rstrip(os.sep) + os.sep):
+            return path
+    return None
+
+
+class IndexedDirectory(object):
+    """One directory in the index, as it was when last read."""
+    __slots__ = ('path', 'mtime', 'files', 'dirs')
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.files = []
+        self.dirs = {}
+
+    def as_tree(self):
+        """The directory as a nested dict, as `get_directory_structure` makes."""
+        tree = dict((name, os.path.join(self.path, name))
+                    for name in self.files)
+        for name, child in self.dirs.items():
+            tree[name] = child.as_tree()
+        return tree
+
+    def count(self):
+        """The number of files and of directories in the directory, recursively."""
+        files, dirs = len(self.files), len(self.dirs)
+        for child in self.dirs.values():
+            child_files, child_dirs = child.count()
+            files += child_files
+            dirs += child_dirs
+        return files, dirs
+
+
+class DirectoryIndex(object):
+    """
+    An in-memory index of the files in the buckets, kept up to date in the
+    background so listing them doesn't touch the disk.
+
+    Every `interval` seconds each indexed directory is stat'ed, and only those
+    whose mtime has changed are read again. If pyinotify is available, the
+    directories it reports changes in are read again straight away as well.
+    """
+    def __init__(self, roots=(), interval=60, render=None):
+        self.roots = list(roots)
+        self.interval = interval
+        self.render = render
+        self.directories = {}
+        self.lines = []
+        self.files = 0
+        self.dirs = 0
+        self.refreshed = None
+        self.build_seconds = None
+        self.refresh_seconds = None
+        self.refreshes = 0
+        self.rescanned = 0
+        self._dirty = set()
+        self._due = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._notifier = None
+
+    def refresh_directory(self, node, scan_started, recursive=True):
+        """
+        Reads `node` again if it's changed since it was last read, and, if
+        `recursive`, does the same for everything under it. Returns True if
+        anything changed, or None if the directory is gone.
+        """
+        try:
+            mtime = os.stat(node.path).st_mtime
+        except OSError:
+            return None
+        changed = False
+        if mtime != node.mtime:
+            try:
+                files, dirs = list_directory(node.path)
+            except OSError:
+                return None
+            node.files = sorted(files)
+            for name in set(node.dirs) - set(dirs):
+                del node.dirs[name]
+            for name in dirs:
+                if name not in node.dirs:
+                    node.dirs[name] = IndexedDirectory(
+                        os.path.join(node.path, name))
+            # Leaves a directory that's only just changed to be read again.
+            node.mtime = mtime if mtime < scan_started - MTIME_SLACK else None
+            self.rescanned += 1
+            changed = True
+        for name, child in list(node.dirs.items()):
+            if not recursive and child.mtime is not None:
+                continue
+            child_changed = self.refresh_directory(child, scan_started)
+            if child_changed is None:
+                del node.dirs[name]
+                changed = True
+            else:
+                changed = changed or child_changed
+        return changed
+
+    def find(self, path):
+        """The indexed directory at `path`, or None. Call with `_lock` held."""
+        for root, node in self.directories.items():
+            if path == node.path:
+                return node
+            if path.startswith(node.path + os.sep):
+                for name in path[len(node.path) + 1:].split(os.sep):
+                    node = node.dirs.get(name)
+                    if node is None:
+                        return None
+                return node
+        return None
+
+    def refresh(self, paths=None):
+        """
+        Brings the index up to date: every directory in it, or just those at
+        `paths` (and any new directories under them).
+        """
+        with self._lock:
+            started = time.time()
+            changed = False
+            if paths is None:
+                for root in self.roots:
+                    node = self.directories.get(root)
+                    if node is None:
+                        node = self.directories[root] = IndexedDirectory(
+                            os.path.abspath(root))
+                    changed = self.refresh_directory(node, started) or changed
+            else:
+                for path in paths:
+                    node = self.find(path)
+                    if node is not None:
+                        changed = self.refresh_directory(
+                            node, started, recursive=False) or changed
+            if changed or self.refreshed is None:
+                tree = [{root: self.directories[root].as_tree()}
+                        for root in self.roots]
+                self.lines = self.render(tree) if self.render else tree
+                self.files, self.dirs = 0, 0
+                for node in self.directories.values():
+                    files, dirs = node.count()
+                    self.files += files
+                    self.dirs += dirs + 1
+            elapsed = time.time() - started
+            if self.build_seconds is None:
+                self.build_seconds = elapsed
+            self.refresh_seconds = elapsed
+            self.refreshes += 1
+            self.refreshed = time.time()
+
+    def list_level(self, path, after=None, limit=100, prefix=None):
+        """
+        Lists one level of the directory `path`, which must be in a bucket:
+        at most `limit` entries in name order, starting after the name
+        `after`, of those whose names start with `prefix`. Names come from
+        the index if it has the directory, and each entry listed gets its
+        size and mtime; symlinks that lead out of the buckets are left out.
+        Returns the entries and the cursor for the next page (None on the
+        last), or None if `path` isn't a directory in a bucket.
+        """
+        path = within_roots(path, self.roots)
+        if path is None or not os.path.isdir(path):
+            return None
+        files = dirs = None
+        # The refresh thread changes the index under the lock, and holds it
+        # for a whole scan, so rather than wait the directory's read afresh.
+        if self._lock.acquire(False):
+            try:
+                node = self.find(path)
+                if node is not None and node.mtime is not None:
+                    files, dirs = list(node.files), list(node.dirs)
+            finally:
+                self._lock.release()
+        if files is None:
+            files, dirs = list_directory(path)
+        kinds = dict.fromkeys(files, 'file')
+        kinds.update(dict.fromkeys(dirs, 'directory'))
+        names = sorted(name for name in kinds
+                       if (after is None or name > after) and
+                       (not prefix or name.startswith(prefix)))
+        cursor = names[limit - 1] if len(names) > limit else None
+        entries = []
+        for name in names[:limit]:
+            full = os.path.join(path, name)
+            if within_roots(full, self.roots) is None:
+                # A symlink out of the buckets; neither listed nor stat'ed.
+                continue
+            try:
+                stat = os.stat(full)
+            except OSError:
+                continue
+            entries.append({
+                'name': name,
+                'path': full,
+                'type': kinds[name],
+                'size': stat.st_size if kinds[name] == 'file' else None,
+                'mtime': stat.st_mtime
+            })
+        return entries, cursor
+
+    def watch(self):
+        """Has pyinotify report changes to the buckets, if it's available."""
+        if pyinotify is None:
+            return
+        index = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.mask & pyinotify.IN_Q_OVERFLOW:
+                    index._dirty.add(None)
+                else:
+                    index._dirty.add(event.path)
+                index._due.set()
+
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        try:
+            for root in self.roots:
+                watches = manager.add_watch(os.path.abspath(root), mask,
+                                            rec=True, auto_add=True)
+                if any(wd < 0 for wd in watches.values()):
+                    raise OSError("Couldn't watch every directory.")
+        except Exception as err:
+            print("Not watching the buckets, polling only:", err)
+            return
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+
+    def run(self):
+        """Builds the index, then keeps it up to date."""
+        self.refresh()
+        self.watch()
+        next_poll = time.time() + self.interval
+        while True:
+            self._due.wait(max(0, next_poll - time.time()))
+            self._due.clear()
+            dirty, self._dirty = self._dirty, set()
+            try:
+                if time.time() >= next_poll or None in dirty:
+                    self.refresh()
+                    next_poll = time.time() + self.interval
+                elif dirty:
+                    self.refresh(dirty)
+            except Exception as err:
+                print("Refreshing the directory index failed:", err)
+
+    def start(self):
+        """Starts building and refreshing the index in the background."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        """Returns the size of the index, how fresh it is and what it took."""
+        return {
+            'files': self.files,
+            'directories': self.dirs,
+            'refreshed': self.refreshed,
+            'age': time.time() - self.refreshed if self.refreshed else None,
+            'build_seconds': self.build_seconds,
+            'refresh_seconds': self.refresh_seconds,
+            'refreshes': self.refreshes,
+            'rescanned_directories': self.rescanned,
+            'watching': self._notifier is not None
+        }
+
+# The process-wide index of the buckets, set up by `configure`.
+INDEX = DirectoryIndex()
+
+
+def configure(config, render=None):
+    """
+    Sets up the process-wide index of the buckets and starts building it.
+    `render` turns the list of bucket trees into what's listed.
+    """
+    INDEX.roots = list(config.buckets)
+    INDEX.interval = config.index_refresh_interval
+    INDEX.render = render
+    INDEX.start()
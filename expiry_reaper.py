@@ -0,0 +1,118 @@
+from __future__ import print_function
+from cache_manager import CACHE
+import threading
+import database
+import datetime
+import os.path
+import time
+import os
+
+
+class ExpiryReaper(object):
+    """
+    Deletes expired links every `interval` seconds, along with the cached
+    files that no other link uses, `batch_size` links per transaction.
+
+    Expired links are found through the index on their expiration date, so a
+    pass only costs as much as there is to reap, however many links there
+    are. Between passes, expired links are still refused; they just aren't
+    gone yet.
+    """
+    def __init__(self, interval=300, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.passes = 0
+        self.reaped_rows = 0
+        self.reaped_files = 0
+        self.reaped_bytes = 0
+        self.last_pass = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def reap(self, now=None):
+        """
+        Deletes every link that expired before the epoch timestamp `now`
+        (default: the present), and the cached files only they used. Returns
+        the number of links and bytes reclaimed.
+        """
+        if now is None:
+            now = database.datetime_to_epoch(datetime.datetime.now())
+        sql_db = database.AlchemyDatabase()
+        rows = reclaimed = files = 0
+        try:
+            while True:
+                file_ids, orphans = sql_db.reap_expired(now, self.batch_size)
+                rows += len(file_ids)
+                for location in orphans:
+                    try:
+                        size = os.path.getsize(location)
+                        os.remove(location)
+                    except OSError:
+                        size = None
+                    if size is not None:
+                        files += 1
+                        reclaimed += size
+                    CACHE.forget(location)
+                if len(file_ids) < self.batch_size:
+                    break
+        finally:
+            database.remove_session()
+        with self._lock:
+            self.passes += 1
+            self.reaped_rows += rows
+            self.reaped_files += files
+            self.reaped_bytes += reclaimed
+            self.last_pass = time.time()
+        if rows:
+            print("Reaped expired links:", rows, "files:", files,
+                  "bytes:", reclaimed)
+        return rows, reclaimed
+
+    def run(self):
+        """Reaps every `interval` seconds until stopped."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.reap()
+            except Exception as err:
+                # Try again next time; the links are still refused meanwhile.
+                print("Reaping expired links failed:", err)
+
+    def start(self):
+        """Starts reaping in the background, unless it's disabled."""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops reaping after the current pass, if any."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Returns what's been reaped so far, and when it last ran."""
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'batch_size': self.batch_size,
+                'passes': self.passes,
+                'reaped_rows': self.reaped_rows,
+                'reaped_files': self.reaped_files,
+                'reaped_bytes': self.reaped_bytes,
+                'last_pass': self.last_pass
+            }
+
+# The process-wide reaper, set up by `configure`.
+REAPER = ExpiryReaper()
+
+
+def configure(config):
+    """Sets up the process-wide reaper from the config and starts it."""
+    REAPER.interval = config.reap_interval
+    REAPER.batch_size = config.reap_batch_size
+    REAPER.start()
@@ -1,22 +1,36 @@
 #!/usr/bin/env python
 from __future__ import print_function
-from flask import Flask, request, render_template, send_file, Response
+from flask import Flask, request, render_template, send_file, Response, abort
+from collections import OrderedDict
 from flask.ext.basicauth import BasicAuth
-import http_streamer
+from werkzeug.wsgi import wrap_file
+import byte_ranges
+import offload
+import buffer_pool
+import cache_manager
+import expiry_reaper
+import directory_index
+import accounting
+import proxy_response
 import mimetypes
 import database
 import os.path
 import json
 import os
-import re
 
 
 app = Flask(__name__)
-app.USE_X_SENDFILE = True
 
 
 CONFIG = database.ConfigReader()
+app.config['USE_X_SENDFILE'] = CONFIG.offload == offload.X_SENDFILE
 DBCLASS = database.AlchemyDatabase
+database.init_database(
+    entry_cache_size=CONFIG.entry_cache_size,
+    entry_cache_max_age=CONFIG.entry_cache_max_age,
+    file_id_length=CONFIG.file_id_length,
+    file_id_alphabet=CONFIG.file_id_alphabet
+)
 
 app.config['BASIC_AUTH_USERNAME'] = CONFIG.username
 app.config['BASIC_AUTH_PASSWORD'] = CONFIG.password
@@ -34,7 +48,10 @@ def get_file_params(file_id):
         raise KeyError("Invalid file id.")
 
     file_location = tmp['file_location']
-    is_remote = tmp['is_remote']
+    # Cached or not, a remote file is served from the cache by CacheResponse,
+    # which keeps it from eviction while it's sent, and fetches it again if
+    # it's been evicted.
+    is_remote = bool(tmp['remote_location'])
 
     if not tmp['file_exists'] and not is_remote:
         raise KeyError("The file for this id does not exist.")
@@ -83,6 +100,15 @@ def build_file_tree_html(tree):
     return lines
 
 
+directory_index.configure(CONFIG, render=build_file_tree_html)
+
+
+@app.teardown_request
+def remove_db_session(exception=None):
+    """Releases this thread's database session at the end of each request."""
+    database.remove_session()
+
+
 # These next two functions are from here:
 #     http://blog.asgaard.co.uk/2012/08/03/http-206-partial-content-for-flask-python
 @app.after_request
@@ -94,7 +120,7 @@ def add_range_headers(response):
 def send_file_partial(path, request):
     """
         Simple wrapper around send_file which handles HTTP 206 Partial Content
-        (byte ranges)
+        (byte ranges), including suffix ranges, multiple ranges and 416s.
         TODO: handle all send_file args, mirror send_file's error handling
         (if it has any)
     """
@@ -102,32 +128,44 @@ def send_file_partial(path, request):
     if not range_header:
         return send_file(path)
 
-    size = os.path.getsize(path)    
-    byte1, byte2 = 0, None
-
-    range_str = re.search('(\d+)-(\d*)', range_header).groups()
+    size = os.path.getsize(path)
+    mimetype = mimetypes.guess_type(path)[0]
+    try:
+        ranges = byte_ranges.parse_range_header(range_header, size)
+    except byte_ranges.RangeNotSatisfiable:
+        to_return = Response("", 416)
+        to_return.headers.add('Content-Range',
+                              byte_ranges.unsatisfiable_range(size))
+        return to_return
+    if not ranges:
+        return send_file(path)
 
-    if range_str[0]:
-        byte1 = int(range_str[0])
-    if range_str[1]:
-        byte2 = int(range_str[1])
+    if len(ranges) > 1:
+        multipart = byte_ranges.MultipartByteranges(ranges, size, mimetype)
+        to_return = Response(multipart.iter_file(open(path, 'rb')),
+                             206,
+                             content_type=multipart.content_type,
+                             direct_passthrough=True)
+        to_return.headers['Content-Length'] = multipart.content_length
+        return to_return
 
-    length = size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1 + 1
+    byte1, byte2 = ranges[0]
+    length = byte2 - byte1 + 1
 
-    data = None
-    with open(path, 'rb') as t_file:
-        t_file.seek(byte1)
-        data = t_file.read(length)
+    # Stream the range rather than reading all of it into memory; the server's
+    # file wrapper is used when it has one.
+    t_file = open(path, 'rb')
+    t_file.seek(byte1)
+    data = wrap_file(request.environ, byte_ranges.FileSlice(t_file, length))
 
     to_return = Response(data, 
                          206,
-                         mimetype=mimetypes.guess_type(path)[0], 
+                         mimetype=mimetype, 
                          direct_passthrough=True)
+    to_return.headers['Content-Length'] = length
     to_return.headers.add(
         'Content-Range',
-        'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size)
+        byte_ranges.content_range(byte1, byte2, size)
     )
 
     return to_return
@@ -157,28 +195,153 @@ def add_url():
         sql_db.new_entry(file_location, expiration_delta)
         return "success"
     else:
-        return render_template('active_links.html', files=sql_db.to_dict(), name="Active Links")
+        return render_active_links()
+
+
+# The most links /add_files/ creates in one request.
+MAX_BULK_LINKS = 10000
+
+@app.route('/add_files/', methods=['POST'])
+@basic_auth.required
+def add_urls():
+    """
+    Adds many file entries in one go. Takes a JSON list of locations, each
+    either a string or an object with a `file_location` and, optionally, an
+    `expiration_delta`, and returns a JSON list with the `file_id` created
+    for each, or the `error` that kept it from being created.
+    """
+    try:
+        items = json.loads(request.data)
+    except ValueError:
+        abort(400)
+    if not isinstance(items, list):
+        abort(400)
+    if len(items) > MAX_BULK_LINKS:
+        abort(413)
+    locations = []
+    for item in items:
+        if isinstance(item, dict):
+            try:
+                delta = int(item.get('expiration_delta', 1))
+            except (TypeError, ValueError):
+                delta = None
+            locations.append((item.get('file_location'), delta))
+        else:
+            locations.append((item, 1))
+    results = DBCLASS().new_entries(locations)
+    response = []
+    for (location, _), result in zip(locations, results):
+        if isinstance(result, Exception):
+            response.append({'file_location': location, 'error': str(result)})
+        else:
+            response.append({'file_location': location, 'file_id': result})
+    return Response(json.dumps(response), mimetype='application/json')
 
 
 @app.route('/list_files/')
 @basic_auth.required
 def get_file_list():
-    buckets = []
-    for b in CONFIG.buckets:
-        tree = get_directory_structure(b)
-        tree = { b: tree[tree.keys()[0]]}
-        buckets.append(tree)
-    buckets = build_file_tree_html(buckets)
+    """Lists the files in the buckets, from the directory index."""
+    return render_template('file_list.html',
+                           file_struct=directory_index.INDEX.lines,
+                           index=directory_index.INDEX.stats(),
+                           name="File List")
+
 
-    return render_template('file_list.html', file_struct=buckets, name="File List")
+# The most links listed on one page, and the default.
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+def listing_args():
+    """
+    Reads the page and filters of a link listing from the query string:
+    `after` (the cursor from the previous page), `limit`, and `expired`,
+    `cached` and `remote`, each "true" or "false".
+    """
+    args = {'after': request.args.get('after') or None}
+    try:
+        args['limit'] = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < args['limit'] <= MAX_PAGE_SIZE:
+        abort(400)
+    for name in ('expired', 'cached', 'remote'):
+        value = request.args.get(name)
+        if value not in (None, 'true', 'false'):
+            abort(400)
+        args[name] = None if value is None else value == 'true'
+    return args
+
+def render_active_links():
+    """Renders one page of the link listing, as asked for in the query string."""
+    args = listing_args()
+    page, cursor = DBCLASS().list_entries(**args)
+    files = OrderedDict((row['file_id'], row) for row in page)
+    filters = dict((name, request.args[name]) for name in
+                   ('limit', 'expired', 'cached', 'remote')
+                   if name in request.args)
+    return render_template('active_links.html', files=files, cursor=cursor,
+                           filters=filters, name="Active Links")
+
+
+@app.route('/browse/')
+@basic_auth.required
+def browse():
+    """Browses the buckets, a directory at a time, as folders are opened."""
+    return render_template('browse.html', buckets=CONFIG.buckets,
+                           name="Browse Files")
+
+
+@app.route('/api/files/')
+@basic_auth.required
+def list_directory():
+    """
+    Returns one level of a directory in a bucket as JSON: `path` is the
+    directory, `after` the cursor from the previous page, `limit` the page
+    size and `prefix` an optional start of the names to list. Without a
+    `path`, lists the buckets.
+    """
+    path = request.args.get('path')
+    if not path:
+        buckets = [{'name': bucket, 'path': os.path.abspath(bucket),
+                    'type': 'directory'} for bucket in CONFIG.buckets]
+        return Response(json.dumps({'entries': buckets, 'next': None}),
+                        mimetype='application/json')
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    listing = directory_index.INDEX.list_level(
+        path, after=request.args.get('after') or None, limit=limit,
+        prefix=request.args.get('prefix'))
+    if listing is None:
+        # Not a directory, or not in a bucket; which isn't given away.
+        abort(404)
+    entries, cursor = listing
+    return Response(json.dumps({'path': os.path.abspath(path),
+                                'entries': entries, 'next': cursor}),
+                    mimetype='application/json')
 
 
 @app.route('/list_active/')
 @basic_auth.required
 def list_active():
-    """Lists all the possible url's and what they point to."""
-    sql_db = DBCLASS()
-    return render_template('active_links.html', files=sql_db.to_dict(), name="Active Links")
+    """Lists the possible url's and what they point to, a page at a time."""
+    return render_active_links()
+
+
+@app.route('/api/links/')
+@basic_auth.required
+def list_links():
+    """
+    Returns a page of links as JSON, along with the cursor for the next page
+    (`null` on the last), taking the same query string as /list_active/.
+    """
+    page, cursor = DBCLASS().list_entries(**listing_args())
+    return Response(json.dumps({'links': page, 'next': cursor}),
+                    mimetype='application/json')
 
 
 
@@ -192,19 +355,52 @@ def download(file_id):
     """Serves the file being requested."""
     file_location, is_remote = get_file_params(file_id)
 
-    def update_file_location(location):
-        sql_db = DBCLASS()
-        sql_db.update_location(file_id, location)
-
     if is_remote:
-        stream = http_streamer.Streamer(\
-            file_location,\
-            cache=True,\
-            cache_location=CONFIG.cache)
-        return Response(stream.generator(update_file_location), mimetype=stream.mimetype)
+        # Filled, or followed, through the same shared cache fill as the
+        # proxy, so a cached object only ever has one writer.
+        sql_db = DBCLASS()
+        context = proxy_response.RequestContext(
+            file_id, proxy_response.extract_request_headers(request.environ),
+            sql_db.get_entry(file_id))
+        response = proxy_response.CacheResponse(context, sql_db, CONFIG)
+        status = response.response_status
+        if status.startswith(("200", "206")):
+            accounting.ACCOUNTING.record(
+                file_id, proxy_response.served_bytes(response))
+        return Response(response.wsgi_body(request.environ), status,
+                        proxy_response.format_response_headers(response),
+                        direct_passthrough=True)
 
     else:
-        return send_file_partial(file_location, request)
+        # When a front-end server is set up to send files, all that's left to
+        # do here is to point it at the file.
+        offload_headers = offload.offload_headers(file_location, CONFIG)
+        if offload_headers:
+            accounting.ACCOUNTING.record(
+                file_id, os.path.getsize(file_location))
+            return Response("", headers=offload_headers)
+        response = send_file_partial(file_location, request)
+        if response.status_code in (200, 206):
+            accounting.ACCOUNTING.record(file_id, response.content_length or 0)
+        return response
+
+
+@app.route('/stats/')
+@basic_auth.required
+def stats():
+    """Reports internal counters, such as entry cache hits and misses."""
+    return Response(
+        json.dumps({
+            'entry_cache': DBCLASS().entry_cache.stats(),
+            'chunk_pool': buffer_pool.CHUNK_POOL.stats(),
+            'cache': cache_manager.CACHE.stats(),
+            'fill_leases': database.LEASE_STATS.stats(),
+            'expiry_reaper': expiry_reaper.REAPER.stats(),
+            'accounting': accounting.ACCOUNTING.stats(),
+            'directory_index': directory_index.INDEX.stats()
+        }),
+        mimetype='application/json'
+    )
 
 
 @app.route('/remove/<file_id>')
@@ -212,15 +408,13 @@ def download(file_id):
 def remove(file_id):
     sql_db = DBCLASS()
 
-    # To keep disk-space lean, when 
-    entry = sql_db.get_entry(file_id)
-    tmp = entry['file_location']
-    tmp = os.path.join(os.path.abspath(CONFIG.cache), os.path.basename(tmp))
-
-    if os.path.exists(tmp):
-        os.remove(tmp)
-
-    sql_db.remove_entry(file_id)
+    # To keep disk-space lean, the cached copy goes too, once no other link
+    # is using it.
+    orphan = sql_db.remove_entry(file_id)
+    if orphan:
+        if os.path.exists(orphan):
+            os.remove(orphan)
+        cache_manager.CACHE.forget(orphan)
     return ""
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+from __future__ import print_function
+import mimetypes
+import os.path
+try:
+    from urllib import quote
+except ImportError:
+    # Python 3, which async_proxy runs on.
+    from urllib.parse import quote
+
+# Supported values of the `offload` config option.
+NONE = "none"
+X_ACCEL_REDIRECT = "x-accel-redirect"
+X_SENDFILE = "x-sendfile"
+MODES = (NONE, X_ACCEL_REDIRECT, X_SENDFILE)
+
+
+def internal_uri(path, locations):
+    """
+    Maps a local `path` onto an nginx internal location, using the longest
+    directory in `locations` (a dict of local directory to URI prefix) that
+    contains it. Returns None if no location contains the path.
+    """
+    path = os.path.abspath(path)
+    best = None
+    for directory in locations:
+        local = os.path.abspath(directory)
+        if path == local or path.startswith(local.rstrip(os.sep) + os.sep):
+            if best is None or len(local) > len(os.path.abspath(best)):
+                best = directory
+    if best is None:
+        return None
+    relative = os.path.relpath(path, os.path.abspath(best))
+    prefix = locations[best].rstrip('/')
+    return prefix + '/' + quote(relative.replace(os.sep, '/'))
+
+
+def offload_headers(path, config):
+    """
+    Returns the headers that tell the front-end server to send the local file
+    at `path` itself, ranges included, or None if offloading is turned off or
+    the file can't be offloaded.
+    """
+    mode = getattr(config, 'offload', NONE)
+    if mode == X_ACCEL_REDIRECT:
+        uri = internal_uri(path, config.offload_locations)
+        if uri is None:
+            return None
+        headers = {'X-Accel-Redirect': uri}
+    elif mode == X_SENDFILE:
+        headers = {'X-Sendfile': os.path.abspath(path)}
+    else:
+        return None
+    mimetype = mimetypes.guess_type(path)[0]
+    if mimetype:
+        headers['Content-Type'] = mimetype
+    return headers
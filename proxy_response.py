@@ -1,13 +1,40 @@
 from __future__ import print_function
-from threading import Thread
-from Queue import Queue, Full
+from threading import Thread, Event
+from buffer_pool import CHUNK_POOL, CHUNK_SIZE, RingBuffer, read_into
+from byte_ranges import FileSlice, MultipartByteranges, RangeNotSatisfiable,\
+    parse_range_header, content_range, unsatisfiable_range
+from cache_fill import CacheFill, ParallelFill, OriginChanged, MAX_RESUMES,\
+    cache_location, content_length, validator, open_range, probe_origin,\
+    finish_from_segments, active_fill
+from segment_cache import segment_map, open_partial
+from cache_manager import CACHE
+from cache_store import object_key
+import cache_fill
+import offload
 import mimetypes
 import urlparse
 import os.path
 import urllib2
 import httplib
 import time
-import re
+
+# How many bytes of a download a ProxyResponse holds for a client that's
+# reading slower than the origin sends; set up by `configure`. It's rounded
+# up to whole chunks, which come out of CHUNK_POOL, so all the responses
+# together never hold more than the pool's cap.
+HANDOFF_BYTES = 1048576
+
+# How long, in seconds, a client can go without reading anything while the
+# hand-off is full before it's taken to have gone. It must allow for slow
+# clients, which can't be told apart from ones that have disconnected.
+STALLED_CLIENT_TIMEOUT = 8
+
+
+def configure(config):
+    """Sets the size of each ProxyResponse's hand-off from the config."""
+    global HANDOFF_BYTES
+    HANDOFF_BYTES = config.proxy_buffer_bytes
+
 
 def get_nocase(d, v):
     for key in d.keys():
@@ -20,9 +47,107 @@ def get_status_from_code(code):
     return str(code)+" "+httplib.responses[code]
 
 
+def extract_request_headers(environ):
+    """Extracts the request headers sent by the client from the environment variables."""
+    to_return = {}
+    for key in environ.keys():
+        if key.startswith("HTTP_"):
+            to_return[key[5:]] = environ[key]
+    return to_return
+
+def format_response_headers(response):
+    """Formats a dictionary of response headers into a list of tuples."""
+    raw_headers = response.response_headers
+    try:
+        if not get_nocase(raw_headers, 'Content-Disposition'):
+            raw_headers['Content-Disposition'] =\
+            'inline; filename="{}"'.format(response.filename)
+    except Exception:
+        pass
+    # Servers insist on string header values, and there's no point sending
+    # headers we couldn't work out (like an unguessable Content-Type).
+    raw_headers = [(x, str(raw_headers[x])) for x in raw_headers
+                   if raw_headers[x] is not None]
+    return raw_headers
+
+
+def served_bytes(response):
+    """The number of bytes the body of a file_id response sends, if known."""
+    if response.offloaded:
+        # The front-end server sends it, and handles any ranges itself.
+        return response.context.size
+    length = get_nocase(response.response_headers, 'Content-Length')
+    try:
+        return int(length)
+    except (TypeError, ValueError):
+        return 0
+
+
+class RequestContext(object):
+    """
+    Everything the responses need to know about a single request, resolved
+    once at dispatch so that serving it doesn't go back to the database.
+    """
+    def __init__(self, request_value, request_headers, entry=None,
+                 remote_url=None):
+        self.request_value = request_value
+        self.request_headers = request_headers
+        self.entry = entry
+        self.file_id = entry['file_id'] if entry else None
+        self.local_path = entry['local_location'] if entry else None
+        self.remote_url = remote_url
+        if remote_url is None and entry:
+            self.remote_url = entry['remote_location']
+        self._size = None
+        self._ranges = False
+
+    @property
+    def origin_headers(self):
+        """The client's request headers, minus those that mustn't be forwarded."""
+        return {key: self.request_headers[key] for key in self.request_headers
+                if key != 'HOST'}
+
+    @property
+    def is_cached(self):
+        """True if the entry has a local copy."""
+        return bool(self.local_path)
+
+    @property
+    def size(self):
+        """Size of the local copy, stat'ed at most once."""
+        if self._size is None:
+            self._size = os.path.getsize(self.local_path)
+        return self._size
+
+    @property
+    def mimetype(self):
+        """Guesses the mimetype of the local copy."""
+        return mimetypes.guess_type(self.local_path)[0]
+
+    @property
+    def ranges(self):
+        """
+        The Range header parsed against the local copy, as a list of
+        `(first, last)` pairs, or None to serve the whole file. Raises
+        RangeNotSatisfiable if none of the ranges are within the file.
+        """
+        if self._ranges is False:
+            self._ranges = parse_range_header(
+                get_nocase(self.request_headers, 'range'), self.size)
+        return self._ranges
+
+    @property
+    def filename(self):
+        """Name of the file being served."""
+        if self.local_path:
+            return os.path.basename(self.local_path)
+        return os.path.basename(urlparse.urlsplit(self.remote_url or "").path)
+
+
 class OtherResponse(object):
     """WSGI response to for a non-valid request."""
-    def __init__(self):
+    def __init__(self, context=None):
+        self.context = context
         self.response_status = get_status_from_code(404)
         self.response_headers = {}
 
@@ -30,15 +155,138 @@ class OtherResponse(object):
         return iter(["404"])
         
 
+def without_range(headers):
+    """Returns a copy of request headers without any Range or If-Range."""
+    return {key: headers[key] for key in headers
+            if key not in ('RANGE', 'IF_RANGE')}
+
+
+class SegmentResponse(object):
+    """
+    Serves one range of a file that isn't fully cached yet. Parts of the
+    range already in the partial cache file are read from disk; the rest are
+    fetched from the origin with range requests and written into the partial
+    file as they pass through, so seeking around a file warms the cache. Once
+    every segment is on disk the file is moved into place like any other
+    finished fill.
+    """
+    def __init__(self, context, config, segments, first, last):
+        self.context = context
+        self.config = config
+        self.segments = segments
+        self.first = first
+        self.last = last
+        self.response_status = get_status_from_code(206)
+        self.response_headers = {
+            'Content-Length': last - first + 1,
+            'Content-Range': content_range(first, last, segments.size),
+            'Content-Type': segments.content_type,
+            'Accept-Ranges': 'bytes'
+        }
+
+    def close(self):
+        """Nothing to do; an abandoned fetch stops when iteration does."""
+        pass
+
+    def fetch(self, t_file, first, last):
+        """
+        Fetches bytes `first` through `last` from the origin, writing them into
+        the partial file and yielding them as they arrive.
+        """
+        try:
+            opener = open_range(self.context.remote_url,
+                                without_range(self.context.origin_headers),
+                                first, last, self.segments.size,
+                                self.segments.validator)
+        except OriginChanged:
+            # Nothing on disk is any good any more.
+            self.segments.reset(None)
+            raise
+        position = first
+        try:
+            for chunk in CHUNK_POOL.chunks(opener, last - first + 1):
+                t_file.seek(position)
+                t_file.write(chunk)
+                self.segments.add(position, position + len(chunk) - 1)
+                position += len(chunk)
+                yield chunk.tobytes()
+        finally:
+            opener.close()
+            self.segments.save()
+        if position <= last:
+            raise IOError("Origin closed the connection early.")
+
+    def __iter__(self):
+        """Yields the range, piece by piece, from disk or the origin."""
+        path = self.segments.path
+        # Unbuffered, so a segment is on disk before it's recorded as such.
+        with open_partial(path) as t_file:
+            for first, last, on_disk in self.segments.pieces(self.first, self.last):
+                if on_disk:
+                    t_file.seek(first)
+                    for chunk in CHUNK_POOL.chunks(t_file, last - first + 1):
+                        yield chunk.tobytes()
+                else:
+                    for data in self.fetch(t_file, first, last):
+                        yield data
+        if self.segments.is_complete:
+            finish_from_segments(self.context.remote_url, self.config)
+
+
+class FillFollower(object):
+    """
+    Streams a file that another request in this process is still filling,
+    reading it from disk as it's written instead of going back to the origin.
+    If the fill fails before it gets going, this falls back to proxying from
+    the origin itself.
+    """
+    def __init__(self, context, fill):
+        self.context = context
+        self.fill = fill
+        self.passthrough = None
+        if fill.wait_started() == cache_fill.FAILED:
+            self.passthrough = ProxyResponse(context)
+            self.response_headers = self.passthrough.response_headers
+            self.response_status = self.passthrough.response_status
+        else:
+            self.response_headers = dict(fill.response_headers)
+            self.response_status = get_status_from_code(fill.response_code)
+
+    def close(self):
+        """Called by the WSGI server once the client is done with the response."""
+        if self.passthrough is not None:
+            self.passthrough.close()
+
+    def __iter__(self):
+        """Yields the file as it lands on disk, waiting wherever it's not yet."""
+        if self.passthrough is not None:
+            for chunk in self.passthrough:
+                yield chunk
+            return
+
+        offset = 0
+        with self.fill.open_for_reading() as t_file:
+            while True:
+                end, state = self.fill.wait_for(offset)
+                if end > offset:
+                    t_file.seek(offset)
+                    for chunk in CHUNK_POOL.chunks(t_file, end - offset):
+                        offset += len(chunk)
+                        yield chunk.tobytes()
+                elif state != cache_fill.STREAMING:
+                    return
+
+
 class CacheResponse(object):
     """
     WSGI middleware to serve a cached response if available, or to create a
     passthrough response while simultaneously caching the file if it hasn't
     been cached yet.
     """
-    def __init__(self, file_id, request_headers, database, config):
-        self.file_id = file_id
-        self.request_headers = request_headers
+    def __init__(self, context, database, config):
+        self.context = context
+        self.file_id = context.file_id
+        self.request_headers = context.request_headers
         self.database = database
         self.config = config
         self.response_headers = {
@@ -46,124 +294,214 @@ class CacheResponse(object):
             "Accept-Ranges" : "bytes"
         }
         self.response_status = None
-        self.download_thread = None
+        self.offloaded = False
+        self.empty_body = False
+        self.multipart = None
 
-        self.is_cached = self.database.is_cached(file_id)
+        self.is_cached = context.is_cached
         self.passthrough = None
         self.byte_range = []
+        self.t_file = None
+
+        if not self.is_cached and context.remote_url:
+            # Another link to the same file may already have cached it.
+            location = database.link_object(
+                self.file_id, object_key(context.remote_url))
+            if location:
+                context.local_path = location
+                self.is_cached = True
+
+        offload_headers = None
+        if self.is_cached:
+            offload_headers = offload.offload_headers(context.local_path, config)
+            if offload_headers:
+                if os.path.exists(context.local_path):
+                    CACHE.offloaded(context.local_path)
+                else:
+                    self.is_cached = False
+            else:
+                # Held open until it's been served, which also keeps it from
+                # being evicted in the meantime.
+                self.t_file = CACHE.open(context.local_path)
+                if self.t_file is None:
+                    self.is_cached = False
+            if not self.is_cached:
+                print("Cached file was evicted.")
 
         if not self.is_cached:
             print("File is not cached.")
-            entry = self.database.get_entry(file_id)
-            self.passthrough = ProxyResponse(entry['remote_location'], request_headers)
+            range_header = get_nocase(self.request_headers, 'range')
+            if range_header:
+                # Ranges are served from, and fetched into, a segmented
+                # partial cache file, if the origin supports it.
+                self.passthrough = self.segment_response(range_header)
+            if self.passthrough is None:
+                self.passthrough = self.fill_response()
             self.response_headers = self.passthrough.response_headers
             self.response_status = self.passthrough.response_status
 
-            self.download_thread = Thread(target=self.download_to_disk)
-            self.download_thread.daemon = True
-            self.download_thread.start()
-
         elif self.is_cached:
-            entry = self.database.get_entry(self.file_id)
-            location = entry['local_location']
-            size = os.path.getsize(location)
-            range_header = get_nocase(self.request_headers, 'range')
-            if range_header:
-                byte1, byte2 = 0, None
-                range_str = re.search('(\d+)-(\d*)', range_header).groups()
-
-                if range_str[0]:
-                    byte1 = int(range_str[0])
-                if range_str[1]:
-                    byte2 = int(range_str[1])
-
-                length = size - byte1
-                if byte2 is not None:
-                    length = byte2 - byte1 + 1
+            if offload_headers:
+                # The front-end server sends the file, and handles any range
+                # request, itself.
+                self.offloaded = True
+                self.empty_body = True
+                self.response_headers = offload_headers
+                self.response_status = get_status_from_code(200)
+                return
 
+            size = context.size
+            self.response_headers['Content-Type'] = context.mimetype
+            try:
+                ranges = context.ranges
+            except RangeNotSatisfiable:
+                self.t_file.close()
+                self.empty_body = True
+                self.response_headers['Content-Type'] = None
+                self.response_headers['Content-Length'] = 0
+                self.response_headers['Content-Range'] = unsatisfiable_range(size)
+                self.response_status = get_status_from_code(416)
+                return
+
+            if ranges and len(ranges) == 1:
+                byte1, byte2 = ranges[0]
                 self.byte_range = [byte1, byte2]
-                self.response_headers['Content-Length'] = length
+                self.response_headers['Content-Length'] = byte2 - byte1 + 1
                 self.response_headers['Content-Range'] = \
-                    'bytes {0}-{1}/{2}'.format(byte1, byte1 + length - 1, size)
+                    content_range(byte1, byte2, size)
+                self.response_status = get_status_from_code(206)
+            elif ranges:
+                self.multipart = MultipartByteranges(
+                    ranges, size, context.mimetype)
+                self.response_headers['Content-Type'] = self.multipart.content_type
+                self.response_headers['Content-Length'] = \
+                    self.multipart.content_length
                 self.response_status = get_status_from_code(206)
-                self.response_headers['Content-Type'] = mimetypes.guess_type(location)[0]
             else:
                 self.response_headers['Content-Length'] = size
-                self.response_headers['Content-Type'] = mimetypes.guess_type(location)[0]
                 self.response_status = get_status_from_code(200)
 
     @property
     def filename(self):
         """Get's the filename for the requested object."""
-        entry = self.database.get_entry(self.file_id)
-        return os.path.basename(entry['local_location'])
+        return self.context.filename
 
 
-    def download_to_disk(self):
-        """Downloads a file to the cache directory."""
-        import database
-        db = database.AlchemyDatabase()
-        # If this is locked, then don't download the file.
-        if db.is_locked(self.file_id):
-            return
-        db.lock_entry(self.file_id)
-        # print("Downloading file to disk.")
+    def segment_response(self, range_header):
+        """
+        Returns a SegmentResponse for a single-range request on an uncached
+        file, or None if the origin can't serve ranges or the request isn't
+        for a single, satisfiable range.
+        """
+        segments = segment_map(
+            cache_location(self.context.remote_url, self.config) + ".part")
+        if segments.size is None:
+            info = probe_origin(self.context.remote_url,
+                                without_range(self.context.origin_headers))
+            if not info or info.get('accept-ranges', '').lower() != 'bytes' or \
+                    content_length(info) is None or info.get('content-encoding'):
+                return None
+            segments.reset(content_length(info), info.get('content-type'),
+                           validator(info))
         try:
-            if 'HOST' in self.request_headers: 
-                del self.request_headers['HOST']
-            
-            url = db.get_entry(self.file_id)['remote_location']
-            request = urllib2.Request(url, headers=self.request_headers)
-            try:
-                opener = urllib2.urlopen(request, timeout=3)
-            except Exception as err:
-                raise err
-
-            fname = os.path.basename(urlparse.urlsplit(url).path)
-            cache_location = os.path.abspath(self.config.cache)
-            location = os.path.join(cache_location, fname)
-            cache_file = open(location, 'wb')
-
-            # Chunk size is 0.5 megabytes
-            chunk_size = 524288
-
-            while True:
-                chunk = opener.read(chunk_size)
-                if not chunk:
-                    break
-                cache_file.write(chunk)
-            # File has been downloaded
-            db.update_location(self.file_id, location)
-            db.unlock_entry(self.file_id)            
-        except Exception as err:
-            # print("Encountered err while downloading to disk: ", err)
-            raise err
-        finally:
-            db.unlock_entry(self.file_id)
-            # print("Database has been unlocked.")
+            ranges = parse_range_header(range_header, segments.size)
+        except RangeNotSatisfiable:
+            return None
+        if not ranges or len(ranges) != 1:
+            return None
+        first, last = ranges[0]
+        return SegmentResponse(self.context, self.config, segments, first, last)
+
+    def fill_response(self):
+        """
+        Returns the response for an uncached file that fills the cache on the
+        way. Usually one connection to the origin feeds both the client and
+        the cache; origin hosts set up for it are filled over several
+        connections instead, with the client following along on disk. A fill
+        that was cut off earlier is picked up where it left off, if the file
+        at the origin hasn't changed since. Any other requests for the file
+        that come in while it's being filled follow along on disk too.
+        """
+        fill = active_fill(self.context.remote_url)
+        if fill is not None:
+            return FillFollower(self.context, fill)
+
+        settings = self.config.parallel_fill_for(self.context.remote_url)
+        segments = segment_map(
+            cache_location(self.context.remote_url, self.config) + ".part")
+        resumable = segments.has_data and segments.validator is not None
+        if settings is not None or resumable:
+            connections, min_segment_bytes = settings or (1, 1)
+            headers = without_range(self.context.origin_headers)
+            info = probe_origin(self.context.remote_url, headers)
+            ranges = info and \
+                info.get('accept-ranges', '').lower() == 'bytes' and \
+                not info.get('content-encoding')
+            resumable = resumable and ranges and \
+                content_length(info) == segments.size and \
+                validator(info) == segments.validator
+            # Not worth it, or not possible, unless the origin serves ranges
+            # of a file big enough for at least two segments, or there's an
+            # earlier fill to finish off.
+            if resumable or (ranges and settings is not None and
+                             content_length(info) >= 2 * min_segment_bytes):
+                fill, created = ParallelFill.join_or_create(
+                    self.context.remote_url, self.config,
+                    info=info, headers=headers, connections=connections,
+                    min_segment_bytes=min_segment_bytes)
+                if created:
+                    fill.launch()
+                return FillFollower(self.context, fill)
+
+        fill, created = CacheFill.join_or_create(
+            self.context.remote_url, self.config)
+        if created:
+            return ProxyResponse(self.context, fill)
+        return FillFollower(self.context, fill)
 
     def return_file(self, byte1=0, byte2=None):
         """Reads a file, or part of a file, and yields it as an iterable."""
-        location = self.database.get_entry(self.file_id)['local_location']
-
-        size = os.path.getsize(location)
+        size = self.context.size
         length = size - byte1
         if byte2 is not None:
             length = byte2 - byte1 + 1
 
-        chunk_size = 524288
-        data = None
-        with open(location, 'rb') as t_file:
+        with self.t_file as t_file:
             t_file.seek(byte1)
-            while True:
-                if length < chunk_size:
-                    data = t_file.read(length)
-                    yield data
-                    break
-                else:
-                    length = length - chunk_size
-                    data = t_file.read(chunk_size)
-                    yield data
+            for chunk in CHUNK_POOL.chunks(t_file, length):
+                # WSGI servers only accept strings, so this is where the
+                # pooled chunk gets copied out.
+                yield chunk.tobytes()
+
+    def close(self):
+        """Called by the WSGI server once the client is done with the response."""
+        if self.passthrough is not None:
+            self.passthrough.close()
+        if self.t_file is not None:
+            self.t_file.close()
+
+    def wsgi_body(self, environ):
+        """
+        Returns the iterable to hand back to the WSGI server. When the server
+        provides `wsgi.file_wrapper`, cached files are returned through it so
+        the server can send them without copying every byte through Python
+        (with sendfile, for servers that support it). Otherwise this response
+        is iterated as usual.
+        """
+        if self.empty_body:
+            return [b""]
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if not self.is_cached or self.multipart or file_wrapper is None:
+            return self
+
+        t_file = self.t_file
+        if self.byte_range:
+            byte1, _ = self.byte_range
+            t_file.seek(byte1)
+            return file_wrapper(
+                FileSlice(t_file, self.response_headers['Content-Length']),
+                CHUNK_SIZE)
+        return file_wrapper(t_file, CHUNK_SIZE)
 
     def __iter__(self):
         """Handles each request case.
@@ -171,16 +509,21 @@ class CacheResponse(object):
         The different cases are:
         1. Uncached request
         2. Cached request (no range headers)
-        3. Cached request *with* range headers
+        3. Cached request *with* a single range
+        4. Cached request *with* several ranges (multipart/byteranges)
         """
 
 
         yieldable = None
+        if self.empty_body:
+            return
         if not self.is_cached:
             yieldable = self.passthrough
             # print("Iterating over passthrough object.")
         elif self.is_cached:
-            if self.byte_range:
+            if self.multipart:
+                yieldable = self.multipart.iter_file(self.t_file)
+            elif self.byte_range:
                 yieldable = self.return_file(
                     self.byte_range[0], self.byte_range[1])
                 # print("Iterating on local file {} from {} to {}".format(
@@ -200,14 +543,27 @@ class CacheResponse(object):
 
 
 class ProxyResponse(object):
-    """A WSGI app that proxys a response from a remote host to the client."""
-    def __init__(self, url, headers):
-        self.url = url
-        self.request_headers = headers
+    """
+    A WSGI app that proxys a response from a remote host to the client. If a
+    CacheFill is given, the same download is also written to the cache, and
+    carries on to the end even if the client goes away.
+
+    The download thread reads straight into a RingBuffer of HANDOFF_BYTES
+    that the client's thread reads from. The client's thread is woken as
+    soon as the status and headers, each piece of data or the end of the
+    download arrive, rather than checking for them every so often.
+    """
+    def __init__(self, context, cache_fill=None):
+        self.context = context
+        self.cache_fill = cache_fill
+        self.url = context.remote_url
+        self.request_headers = context.origin_headers
         self._response_headers = None
         self._response_code = None
-        self.data_queue = Queue(1)
-        self.finished_download = False
+        self._started = Event()
+        self.handoff = RingBuffer(HANDOFF_BYTES)
+        self.client_closed = False
+        self.resumes = 0
 
         self.open_error = False
 
@@ -217,74 +573,135 @@ class ProxyResponse(object):
 
     def download_file(self):
         """Downloads the file in a seperate thread."""
-        if 'HOST' in self.request_headers: del self.request_headers['HOST']
         request = urllib2.Request(self.url, headers=self.request_headers)
         try:
             # print("thread: Downloading file", self.url)
             opener = urllib2.urlopen(request, timeout=3)
             # print('thread: Headers:', self.request_headers)
-        except urllib2.HTTPError as err:
+        except Exception as err:
             self._response_headers = {}
-            self._response_code = err.getcode()
-            self.finished_download = True
+            if isinstance(err, urllib2.HTTPError):
+                self._response_code = err.getcode()
+            else:
+                # Rather than leave the client waiting for a response that's
+                # never coming.
+                print("Couldn't reach the origin:", err)
+                self._response_code = 502
             self.open_error = True
+            self._started.set()
+            self.handoff.finish()
+            if self.cache_fill is not None:
+                self.cache_fill.abort()
             return
-        except Exception as err:
-            # print(e.message)
-            raise err
 
         # size = int(opener.headers['content-length'])
-        # Chunk size is 0.5 megabytes
-        chunk_size = 524288
 
         self._response_headers = dict(opener.info())
         self._response_code = opener.getcode()
-
-        # if self.should_cache:
-        #     fname = self.filename
-        #     location = os.path.join(os.path.abspath(self.cache_location), fname)
-        #     c_file = open(location, 'wb')
+        self._started.set()
+
+        # Only a complete, unencoded body is any use to the cache.
+        fill = None
+        if self.cache_fill is not None:
+            if self._response_code == 200 and \
+                    not get_nocase(self._response_headers, 'content-encoding'):
+                if self.cache_fill.start(
+                        self._response_code, self._response_headers):
+                    fill = self.cache_fill
+            else:
+                self.cache_fill.abort()
 
         # print("thread: Begin reading in data.")
         # import datetime
-        while True:
-            chunk = opener.read(chunk_size)
-            if not chunk:
-                break
-            # If the client hasn't read 0.5 mb of data in 5 seconds, assume
-            # that the client has disconnected and exit this thread. The
-            # timeout for this must accomadate for slow clients, since a
-            # sufficiently slow client will not empty the queue in time.
+        complete = False
+        buf = None
+        try:
+            while fill is not None or not self.client_closed:
+                # Read straight into the hand-off while the client's there;
+                # once it's gone, into a pooled buffer for the fill alone.
+                view = None
+                if not self.client_closed:
+                    view = self.handoff.writable(
+                        CHUNK_SIZE, STALLED_CLIENT_TIMEOUT)
+                    if view is None:
+                        # Gone, or stalled for long enough to count as gone.
+                        self.close()
+                        continue
+                elif buf is None:
+                    buf = CHUNK_POOL.acquire()
+                    view = memoryview(buf)
+                else:
+                    view = memoryview(buf)
+                try:
+                    read = read_into(opener, view)
+                    if not read and fill is not None and \
+                            fill.size is not None and fill.written < fill.size:
+                        raise IOError("Origin closed the connection early.")
+                except Exception:
+                    resumed = self.resume(fill)
+                    if resumed is None:
+                        raise
+                    opener.close()
+                    opener = resumed
+                    continue
+                if not read:
+                    complete = True
+                    break
+                if fill is not None:
+                    try:
+                        fill.write(view[:read])
+                    except Exception:
+                        fill.abort()
+                        fill = None
+                if buf is None:
+                    self.handoff.commit(read)
+        finally:
+            if buf is not None:
+                CHUNK_POOL.release(buf)
+            # The fill's recorded before the client sees the end of the body,
+            # so a request that follows straight on finds the file cached.
             try:
-                # start = (datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds()
-                self.data_queue.put(chunk, block=True, timeout=8)
-                # end = (datetime.datetime.now() - datetime.datetime(1970, 1, 1)).total_seconds()
-                # print("Time in queue:", end-start)
-                # if self.should_cache:
-                #     c_file.write(chunk)
-            except Full:
-                # print("Client has disconnected, stopping reading.")
-                break
-        self.finished_download = True
+                if fill is not None:
+                    if complete:
+                        fill.finish()
+                    else:
+                        fill.abort()
+            finally:
+                self.handoff.finish()
         # if self.update_callback:
         #     self.update_callback(location)
         # print("Finished download!")
 
+    def resume(self, fill):
+        """
+        Asks the origin for the rest of a fill whose download was cut off,
+        provided the file hasn't changed. Returns the new response, or None
+        if there's no fill, the origin can't serve ranges, or it's been tried
+        too often.
+        """
+        if fill is None or not fill.validator or fill.size is None or \
+                self.resumes >= MAX_RESUMES or (get_nocase(
+                    self._response_headers, 'accept-ranges') or '') != 'bytes':
+            return None
+        self.resumes += 1
+        try:
+            return open_range(self.url, without_range(self.request_headers),
+                              fill.written, fill.size - 1, fill.size,
+                              fill.validator)
+        except Exception:
+            return None
+
     @property
     def response_status(self):
         """Returns response status, blocking till the response code is set."""
-        while True:
-            if self._response_code:
-                return get_status_from_code(int(self._response_code))
-            else: time.sleep(0.1)
+        self._started.wait()
+        return get_status_from_code(int(self._response_code))
 
     @property
     def response_headers(self):
         """Blocks till the response headers are set."""
-        while True:
-            if self._response_headers:
-                return self._response_headers
-            else: time.sleep(0.1)
+        self._started.wait()
+        return self._response_headers
 
     @property
     def filename(self):
@@ -292,19 +709,24 @@ class ProxyResponse(object):
         path = urlparse.urlsplit(self.url).path
         return os.path.basename(path)
 
+    def close(self):
+        """Called by the WSGI server once the client is done with the response."""
+        self.client_closed = True
+        self.handoff.close()
+
     def __iter__(self):
-        """Yields the data being downloaded."""
+        """Yields the data being downloaded, as soon as it arrives."""
         if self.open_error:
             yield ""
             return
-        while not self.finished_download or not self.data_queue.empty():
-            if not self.data_queue.empty():
-                data = self.data_queue.get()
+        try:
+            while True:
+                data = self.handoff.read(CHUNK_SIZE)
+                if not data:
+                    return
                 yield data
-            # This sleep is especially important, since it stops the CPU from
-            # spending all it's time whirling through this loop and sucking up
-            # CPU.
-            else: time.sleep(0.1)
+        finally:
+            self.close()
 
 
 def main():
@@ -320,7 +742,7 @@ def main():
         # 'HOST': 'localhost:9999',
         'USER_AGENT': 'Mozilla/5.0 (Windows NT 6.3; WOW64; rv:35.0) Gecko/20100101 Firefox/35.0'
     }
-    file_response = ProxyResponse(rand_url, headers)
+    file_response = ProxyResponse(RequestContext(rand_url, headers, remote_url=rand_url))
     print(file_response.response_headers)
     print(file_response.filename)
 
@@ -334,6 +756,52 @@ def profile():
     import cProfile
     cProfile.run('main()')
 
+def benchmark_pool(path, clients=32, rounds=4):
+    """
+    Serves the local file at `path` to `clients` concurrent readers through
+    CacheResponse and reports chunk pool occupancy and peak resident memory.
+    """
+    entry = {'file_id': 'benchmark', 'local_location': path,
+             'remote_location': ''}
+
+    def client():
+        for _ in range(rounds):
+            context = RequestContext('benchmark', {}, entry)
+            for _ in CacheResponse(context, None, None):
+                pass
+
+    start = time.time()
+    threads = [Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    served = os.path.getsize(path) * clients * rounds
+    print("Served {:.1f} MB in {:.2f}s".format(served / 1048576.0, elapsed))
+    for key, value in sorted(CHUNK_POOL.stats().items()):
+        print("{:<12} {}".format(key, value))
+
+def benchmark_handoff(url, rounds=20):
+    """
+    Proxies `url` uncached `rounds` times and reports how long the status,
+    the first byte and the last byte each take to reach the client.
+    """
+    totals = [0.0, 0.0, 0.0]
+    for _ in range(rounds):
+        start = time.time()
+        response = ProxyResponse(RequestContext(url, {}, remote_url=url))
+        response.response_status
+        totals[0] += time.time() - start
+        first = True
+        for _ in response:
+            if first:
+                totals[1] += time.time() - start
+                first = False
+        totals[2] += time.time() - start
+    for name, total in zip(("status", "first byte", "last byte"), totals):
+        print("{:<12} {:.1f}ms".format(name, total * 1000 / rounds))
 
 
 if __name__ == '__main__':
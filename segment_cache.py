@@ -0,0 +1,199 @@
+from __future__ import print_function
+import threading
+import os.path
+import json
+import os
+
+# Segment maps in use by this process, by the path of their partial file, so
+# that every request working on a file shares one view of what's on disk.
+_SEGMENT_MAPS = {}
+_SEGMENT_LOCK = threading.Lock()
+
+# How many bytes can be added to a map before it's saved again, so a fill
+# that's killed outright loses at most this much of its progress.
+SAVE_EVERY = 16 * 1024 * 1024
+
+
+def segment_map(path):
+    """Returns this process's SegmentMap for the partial file at `path`."""
+    with _SEGMENT_LOCK:
+        if path not in _SEGMENT_MAPS:
+            _SEGMENT_MAPS[path] = SegmentMap(path)
+        return _SEGMENT_MAPS[path]
+
+
+def open_partial(path):
+    """
+    Opens the partial file at `path` for reading and writing, unbuffered,
+    creating it if it isn't there. Never truncated, since another request
+    may have created it, and written segments to it, in the meantime.
+    """
+    return os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b', 0)
+
+
+def merge_extents(extents):
+    """Sorts a list of `(first, last)` extents, merging any that touch."""
+    merged = []
+    for first, last in sorted(extents):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class SegmentMap(object):
+    """
+    Records which byte ranges of a partially cached file are on disk.
+
+    The partial file is sparse: segments are written at their own offsets as
+    they're fetched, in any order. The extents are kept next to it in a
+    `.extents` file, so they survive restarts. Extents are only ever added
+    after their bytes are written, and saving merges with what's already on
+    disk, so several writers can share a file without ever claiming bytes
+    that aren't there.
+
+    The origin's validator (its ETag or Last-Modified) for the version of the
+    file the extents belong to is kept too, so that segments of a file that
+    has since changed are never mixed with the new one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.extents_path = path + ".extents"
+        self.size = None
+        self.content_type = None
+        self.validator = None
+        self.extents = []
+        self.unsaved = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Reads the extents file, if there is one."""
+        with self.lock:
+            try:
+                with open(self.extents_path, 'r') as extents_file:
+                    saved = json.load(extents_file)
+            except (IOError, ValueError):
+                return
+            if not os.path.exists(self.path):
+                return
+            self.size = saved.get('size')
+            self.content_type = saved.get('content_type')
+            self.validator = saved.get('validator')
+            self.extents = merge_extents(
+                [tuple(x) for x in saved.get('extents', [])])
+
+    def save(self):
+        """Writes the extents file, merging with whatever's already there."""
+        with self.lock:
+            try:
+                with open(self.extents_path, 'r') as extents_file:
+                    saved = json.load(extents_file)
+                if saved.get('size') == self.size and \
+                        saved.get('validator') == self.validator:
+                    self.extents = merge_extents(
+                        self.extents + [tuple(x) for x in saved['extents']])
+            except (IOError, ValueError, KeyError):
+                pass
+            temp_path = self.extents_path + ".tmp"
+            with open(temp_path, 'w') as extents_file:
+                json.dump({
+                    'size': self.size,
+                    'content_type': self.content_type,
+                    'validator': self.validator,
+                    'extents': self.extents
+                }, extents_file)
+            os.rename(temp_path, self.extents_path)
+            self.unsaved = 0
+
+    def reset(self, size, content_type=None, validator=None):
+        """
+        Starts over for a file of `size` bytes with the origin validator
+        `validator`, throwing away anything recorded for a different version
+        of the file. `reset(None)` throws everything away.
+        """
+        with self.lock:
+            if size is not None and size == self.size and \
+                    validator == self.validator:
+                self.content_type = content_type or self.content_type
+                return
+            self.size = size
+            self.content_type = content_type
+            self.validator = validator
+            self.extents = []
+            self.unsaved = 0
+            if os.path.exists(self.extents_path):
+                os.remove(self.extents_path)
+            if os.path.exists(self.path):
+                with open(self.path, 'r+b') as t_file:
+                    t_file.truncate(0)
+
+    def add(self, first, last):
+        """
+        Records that bytes `first` through `last` are on disk, saving the map
+        every so often.
+        """
+        with self.lock:
+            self.extents = merge_extents(self.extents + [(first, last)])
+            self.unsaved += last - first + 1
+            if self.unsaved >= SAVE_EVERY:
+                self.save()
+
+    def contiguous_from(self, offset):
+        """Returns how many bytes are on disk starting at `offset`."""
+        with self.lock:
+            for first, last in self.extents:
+                if first <= offset <= last:
+                    return last - offset + 1
+            return 0
+
+    def pieces(self, first, last):
+        """
+        Splits the range `first`-`last` into `(first, last, on_disk)` pieces,
+        in order, so it can be served partly from disk and partly from the
+        origin.
+        """
+        with self.lock:
+            pieces = []
+            position = first
+            for ext_first, ext_last in self.extents:
+                if ext_last < position or ext_first > last:
+                    continue
+                if ext_first > position:
+                    pieces.append((position, ext_first - 1, False))
+                pieces.append((max(ext_first, position), min(ext_last, last), True))
+                position = min(ext_last, last) + 1
+                if position > last:
+                    break
+            if position <= last:
+                pieces.append((position, last, False))
+            return pieces
+
+    @property
+    def has_data(self):
+        """True if any of the file is on disk."""
+        with self.lock:
+            return self.size is not None and bool(self.extents)
+
+    @property
+    def is_complete(self):
+        """True once every byte of the file is on disk."""
+        with self.lock:
+            if self.size is None:
+                return False
+            if self.size == 0:
+                return True
+            return self.extents == [(0, self.size - 1)]
+
+    def discard(self):
+        """Forgets the map once the file is complete, or abandoned."""
+        with _SEGMENT_LOCK:
+            if _SEGMENT_MAPS.get(self.path) is self:
+                del _SEGMENT_MAPS[self.path]
+        with self.lock:
+            self.extents = []
+            self.size = None
+            self.validator = None
+            if os.path.exists(self.extents_path):
+                os.remove(self.extents_path)